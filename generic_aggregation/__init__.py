@@ -1 +1,7 @@
 from generic_aggregation.utils import generic_aggregate, generic_annotate, generic_filter
+from generic_aggregation.utils import generic_aggregate_shards, generic_annotate_iterator, generic_annotate_keyset
+from generic_aggregation.utils import generic_annotate_top, generic_annotate_values, generic_reduce, generic_update
+from generic_aggregation.utils import warm_content_types
+from generic_aggregation.lazy import AggregateCollector, lazy_generic_aggregate
+
+default_app_config = 'generic_aggregation.apps.GenericAggregationConfig'
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class GenericAggregationConfig(AppConfig):
+    name = 'generic_aggregation'
+    verbose_name = 'Generic aggregation'
+
+    def ready(self):
+        from generic_aggregation.indexes import check_gfk_indexes
+
+        checks.register(check_gfk_indexes, checks.Tags.models)
@@ -0,0 +1,334 @@
+"""
+Every query generated by generic_aggregation filters the GFK table on its
+content type and object id columns, so without a composite index on those
+columns each aggregate is a full table scan.
+"""
+
+import itertools
+import uuid
+from collections import namedtuple
+
+from django.apps import apps
+from django.core import checks
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+GFKIndexReport = namedtuple('GFKIndexReport', (
+    'model',     # the model holding the GFK, e.g. Rating
+    'gfk_field', # the GenericForeignKey itself
+    'fields',    # the fields a suitable index should lead with
+    'columns',   # ... and their columns
+    'usable',    # names of existing indexes suitable for GFK lookups
+    'unused',    # names of indexes on GFK columns the planner did not use
+    'plan',      # the EXPLAIN output of a representative lookup
+))
+
+
+def get_gfk_fields(model):
+    from django.contrib.contenttypes.fields import GenericForeignKey
+
+    return [field for field in model._meta.virtual_fields
+            if isinstance(field, GenericForeignKey)]
+
+def gfk_models(app_configs=None):
+    """
+    Yield a (model, gfk_field) 2-tuple for every concrete model with a GFK.
+    """
+    if app_configs is None:
+        models = apps.get_models()
+    else:
+        models = itertools.chain(*[
+            app_config.get_models() for app_config in app_configs])
+
+    for model in models:
+        if model._meta.proxy or model._meta.swapped:
+            continue
+        for gfk_field in get_gfk_fields(model):
+            yield model, gfk_field
+
+def gfk_index_fields(model, gfk_field, covering=None):
+    fields = [gfk_field.ct_field, gfk_field.fk_field]
+    if covering:
+        fields.append(covering)
+    return fields
+
+def gfk_index_columns(model, gfk_field, covering=None):
+    opts = model._meta
+    return [opts.get_field(name).column
+            for name in gfk_index_fields(model, gfk_field, covering)]
+
+def is_gfk_index(columns, gfk_columns):
+    # both leading columns are compared for equality, so their order does not
+    # matter, but any covering column has to follow them
+    width = len(gfk_columns)
+    if len(columns) < width or set(columns[:2]) != set(gfk_columns[:2]):
+        return False
+    return columns[2:width] == gfk_columns[2:]
+
+def declared_indexes(model):
+    """
+    The column lists of the multi-column indexes declared on the model's Meta.
+    """
+    opts = model._meta
+    declared = list(opts.index_together) + list(opts.unique_together)
+    declared.extend(index.fields for index in getattr(opts, 'indexes', ()))
+    return [[opts.get_field(name.lstrip('-')).column for name in fields]
+            for fields in declared]
+
+def check_gfk_indexes(app_configs=None, **kwargs):
+    errors = []
+    for model, gfk_field in gfk_models(app_configs):
+        gfk_columns = gfk_index_columns(model, gfk_field)
+        if any(is_gfk_index(columns, gfk_columns)
+               for columns in declared_indexes(model)):
+            continue
+
+        errors.append(checks.Warning(
+            'Generic foreign key "%s" has no index on (%s).' % (
+                gfk_field.name, ', '.join(gfk_columns)),
+            hint='Add %r to Meta.index_together and run makemigrations, or '
+                 'run the gfk_indexes management command to generate the '
+                 'migration.' % (
+                     tuple(gfk_index_fields(model, gfk_field)),),
+            obj=model,
+            id='generic_aggregation.W001',
+        ))
+    return errors
+
+
+###############################################################################
+# database introspection
+
+def explain(sql, params, using=DEFAULT_DB_ALIAS):
+    """
+    Return the query plan of ``sql`` as a list of strings, one per plan row.
+    """
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(prefix + sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail)
+        return [row[-1] for row in rows]
+    return [' '.join(str(col) for col in row if col is not None) for row in rows]
+
+def get_indexes(model, using=DEFAULT_DB_ALIAS):
+    """
+    Return a dictionary mapping index name -> list of columns.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    try:
+        constraints = connection.introspection.get_constraints(
+            cursor, model._meta.db_table)
+    finally:
+        cursor.close()
+
+    return dict(
+        (name, info['columns']) for name, info in constraints.items()
+        if info['index'] or info['unique'])
+
+def foreign_key_indexes(model):
+    """
+    The column lists of the indexes Django creates for foreign keys, which
+    cannot be dropped without setting db_index=False.
+    """
+    from django.db import models
+
+    return [[field.column] for field in model._meta.concrete_fields
+            if isinstance(field, models.ForeignKey) and field.db_index]
+
+def gfk_target_models(model, gfk_field):
+    """
+    The models with a GenericRelation to ``gfk_field``, i.e. those the queries
+    run against ``model``'s table are generated for.
+    """
+    from django.contrib.contenttypes.fields import GenericRelation
+
+    targets = []
+    for target in apps.get_models():
+        for field in target._meta.get_fields():
+            if (isinstance(field, GenericRelation) and
+                    field.related_model is model and
+                    field.content_type_field_name == gfk_field.ct_field and
+                    field.object_id_field_name == gfk_field.fk_field):
+                targets.append(target)
+                break
+    return targets
+
+def gfk_queries(model, gfk_field, covering=None, using=DEFAULT_DB_ALIAS):
+    """
+    Return the (SQL, params) 2-tuples of representative queries run against
+    ``model``'s table: the aggregate and the annotation generated for the
+    first model with a GenericRelation to it.  Without one, only the lookup
+    every generated query performs is returned.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Count
+
+    from generic_aggregation.utils import fallback_generic_annotate
+    from generic_aggregation.utils import generic_aggregate_sql
+    from generic_aggregation.utils import query_as_sql
+
+    aggregator = Count(covering or model._meta.pk.name)
+    generic_qs = model._default_manager.using(using).all()
+    for target in gfk_target_models(model, gfk_field):
+        # looking up a missing content type would create it
+        if not ContentType.objects.db_manager(using).filter(
+                app_label=target._meta.app_label,
+                model=target._meta.model_name).exists():
+            continue
+
+        qs = target._default_manager.using(using).all()
+        annotated = fallback_generic_annotate(qs, generic_qs, aggregator, gfk_field)
+        return [
+            generic_aggregate_sql(qs, generic_qs, aggregator, gfk_field),
+            query_as_sql(annotated.query, using),
+        ]
+
+    return [gfk_lookup_sql(model, gfk_field, covering, using)]
+
+def gfk_lookup_sql(model, gfk_field, covering=None, using=DEFAULT_DB_ALIAS):
+    """
+    Build the lookup every generated query performs: the rows of a single
+    content type with a single object id.
+    """
+    from generic_aggregation.utils import get_field_type
+
+    qn = connections[using].ops.quote_name
+    opts = model._meta
+    ct_column, fk_column = gfk_index_columns(model, gfk_field)[:2]
+    fk_field = opts.get_field(gfk_field.fk_field)
+
+    if covering:
+        selected = 'COUNT(%s)' % qn(opts.get_field(covering).column)
+    else:
+        selected = 'COUNT(*)'
+
+    # use a real row so the parameters have the columns' types, and so no
+    # content type has to be looked up, which could create one
+    row = model._default_manager.using(using).values_list(
+        gfk_field.ct_field, gfk_field.fk_field).order_by().first()
+    if row is not None:
+        content_type_id, object_id = row
+    elif get_field_type(fk_field, using) == 'uuid':
+        content_type_id, object_id = 1, uuid.UUID(int=1)
+    else:
+        content_type_id, object_id = 1, fk_field.to_python('1')
+
+    sql = 'SELECT %s FROM %s WHERE %s = %%s AND %s = %%s' % (
+        selected,
+        qn(opts.db_table),
+        qn(ct_column),
+        qn(fk_column),
+    )
+    params = [
+        content_type_id,
+        fk_field.get_db_prep_value(object_id, connections[using]),
+    ]
+    return sql, params
+
+def inspect_gfk_indexes(model, gfk_field, covering=None, using=DEFAULT_DB_ALIAS):
+    gfk_columns = gfk_index_columns(model, gfk_field, covering)
+    indexes = get_indexes(model, using)
+
+    plan = []
+    for sql, params in gfk_queries(model, gfk_field, covering, using):
+        plan.extend(explain(sql, params, using))
+    plan_text = ' '.join(plan)
+
+    foreign_keys = foreign_key_indexes(model)
+    usable = []
+    unused = []
+    for name, columns in sorted(indexes.items()):
+        if is_gfk_index(columns, gfk_columns):
+            usable.append(name)
+        elif columns in foreign_keys:
+            continue
+        elif (set(columns) & set(gfk_columns[:2])) and name not in plan_text:
+            unused.append(name)
+
+    return GFKIndexReport(
+        model,
+        gfk_field,
+        gfk_index_fields(model, gfk_field, covering),
+        gfk_columns,
+        usable,
+        unused,
+        plan)
+
+
+###############################################################################
+# migrations
+
+MIGRATION_TEMPLATE = """from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+%(dependencies)s
+    ]
+
+    operations = [
+%(operations)s
+    ]
+"""
+
+OPERATION_TEMPLATE = """        migrations.AlterIndexTogether(
+            name=%(name)r,
+            index_together=set([%(index_together)s]),
+        ),"""
+
+def gfk_index_together(reports):
+    """
+    Return a (model, index_together) 2-tuple for each model of ``reports``,
+    its index_together with the missing indexes added.
+    """
+    by_model = {}
+    for report in reports:
+        by_model.setdefault(report.model, []).append(report)
+
+    result = []
+    for model, model_reports in sorted(by_model.items(),
+                                       key=lambda item: item[0]._meta.model_name):
+        # AlterIndexTogether replaces the existing set, so keep what is there
+        index_together = set(tuple(fields) for fields in model._meta.index_together)
+        for report in model_reports:
+            index_together.add(tuple(report.fields))
+        result.append((model, sorted(index_together)))
+    return result
+
+def gfk_index_migration(app_label, reports):
+    """
+    Render a migration adding the indexes missing from ``reports``, all of
+    which must belong to ``app_label``.
+    """
+    from django.db.migrations.loader import MigrationLoader
+
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    dependencies = [
+        '        (%r, %r),' % node
+        for node in sorted(loader.graph.leaf_nodes())
+        if node[0] == app_label]
+
+    operations = []
+    for model, index_together in gfk_index_together(reports):
+        operations.append(OPERATION_TEMPLATE % {
+            'name': model._meta.model_name,
+            'index_together': ', '.join(repr(fields) for fields in sorted(index_together)),
+        })
+
+    return MIGRATION_TEMPLATE % {
+        'dependencies': '\n'.join(dependencies),
+        'operations': '\n'.join(operations),
+    }
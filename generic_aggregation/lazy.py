@@ -0,0 +1,175 @@
+"""
+Lazy aggregates are only computed once used, e.g. displayed in a template, and
+every aggregate still pending in the same collector is computed along with it,
+in a single query.
+"""
+
+import threading
+
+from django.db import connections
+from django.utils import six
+from django.utils.encoding import python_2_unicode_compatible
+
+from generic_aggregation.utils import generic_aggregate_sql, normalize_qs_model
+
+
+_active = threading.local()
+
+
+def get_collector():
+    """
+    Return the collector active in the current thread, if any.
+    """
+    return getattr(_active, 'collector', None)
+
+def lazy_generic_aggregate(qs_model, generic_qs_model, aggregator, gfk_field=None):
+    """
+    Same as generic_aggregate, but the query is deferred until the value is
+    used, and shared with the other pending aggregates of the active
+    collector:
+
+        with AggregateCollector():
+            avg_rating = lazy_generic_aggregate(Food, Rating, Avg('ratings__rating'))
+            num_ratings = lazy_generic_aggregate(Food, Rating, Count('ratings__rating'))
+            print avg_rating, num_ratings # a single query
+
+    :rtype: a LazyAggregate, whose ``value`` is the result of the aggregation
+    """
+    collector = get_collector() or AggregateCollector()
+    return collector.add(qs_model, generic_qs_model, aggregator, gfk_field)
+
+
+class AggregateCollector(object):
+    def __init__(self):
+        self.pending = []
+        self.previous = []
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.deactivate()
+
+    def activate(self):
+        """
+        Make this the collector of the lazy aggregates created by the current
+        thread.
+        """
+        self.previous.append(get_collector())
+        _active.collector = self
+
+    def deactivate(self):
+        _active.collector = self.previous.pop()
+
+    def add(self, qs_model, generic_qs_model, aggregator, gfk_field=None):
+        aggregate = LazyAggregate(
+            self,
+            normalize_qs_model(qs_model),
+            normalize_qs_model(generic_qs_model),
+            aggregator,
+            gfk_field)
+        self.pending.append(aggregate)
+        return aggregate
+
+    def evaluate(self, aggregate):
+        """
+        Compute ``aggregate`` and the pending aggregates run on the same
+        database with one query, selecting each aggregate as a subquery.
+        Identical aggregates are only selected once.  A pending aggregate
+        which cannot be computed is left out, and only raises once used.
+        """
+        using = aggregate.generic_qs.db
+
+        # the errors of the aggregate being used are raised
+        batch = [(aggregate, aggregate.sql())]
+        for pending in self.pending:
+            if pending is aggregate or pending.generic_qs.db != using:
+                continue
+            try:
+                batch.append((pending, pending.sql()))
+            except Exception:
+                continue
+
+        columns = {}
+        select, params = [], []
+        for pending, (sql, sql_params) in batch:
+            key = (sql, tuple(sql_params))
+            if key not in columns:
+                columns[key] = len(select)
+                select.append('(%s)' % sql)
+                params.extend(sql_params)
+            pending.column = columns[key]
+
+        cursor = connections[using].cursor()
+        cursor.execute('SELECT %s' % ', '.join(select), params)
+        row = cursor.fetchone()
+
+        for pending, _ in batch:
+            pending.result = row[pending.column]
+            pending.evaluated = True
+
+        # dropped from pending only once computed, so they stay pending if the
+        # query fails.  compared by identity, as == would evaluate them
+        computed = set(id(pending) for pending, _ in batch)
+        self.pending = [pending for pending in self.pending if id(pending) not in computed]
+
+
+@python_2_unicode_compatible
+class LazyAggregate(object):
+    """
+    The result of an aggregation, computed on first use.
+    """
+    def __init__(self, collector, qs, generic_qs, aggregator, gfk_field=None):
+        self.collector = collector
+        self.qs = qs
+        self.generic_qs = generic_qs
+        self.aggregator = aggregator
+        self.gfk_field = gfk_field
+        self.evaluated = False
+        self.result = None
+
+    def sql(self):
+        return generic_aggregate_sql(self.qs, self.generic_qs, self.aggregator, self.gfk_field)
+
+    @property
+    def value(self):
+        if not self.evaluated:
+            self.collector.evaluate(self)
+        return self.result
+
+    def __str__(self):
+        return six.text_type(self.value)
+
+    def __repr__(self):
+        return '<LazyAggregate: %r>' % (self.value,)
+
+    def __bool__(self):
+        return bool(self.value)
+    __nonzero__ = __bool__
+
+    def __int__(self):
+        return int(self.value)
+
+    def __float__(self):
+        return float(self.value)
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __lt__(self, other):
+        return self.value < other
+
+    def __le__(self, other):
+        return self.value <= other
+
+    def __gt__(self, other):
+        return self.value > other
+
+    def __ge__(self, other):
+        return self.value >= other
+
+    __hash__ = None
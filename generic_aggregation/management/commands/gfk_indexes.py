@@ -0,0 +1,72 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from generic_aggregation.indexes import gfk_index_migration
+from generic_aggregation.indexes import gfk_index_together
+from generic_aggregation.indexes import gfk_models
+from generic_aggregation.indexes import inspect_gfk_indexes
+
+
+class Command(BaseCommand):
+    help = ('Reports missing or unused indexes on the tables of models with a '
+            'generic foreign key, and prints a migration adding the missing ones.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='*',
+            help='Only inspect the models of these apps.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to inspect. Defaults to the "default" database.')
+        parser.add_argument('--cover', action='append', default=[],
+            metavar='APP_LABEL.MODEL.FIELD',
+            help='Also include FIELD, the column being aggregated, in the '
+                 'index of APP_LABEL.MODEL so it covers the aggregate.')
+
+    def handle(self, *app_labels, **options):
+        try:
+            app_configs = [apps.get_app_config(label) for label in app_labels] or None
+        except LookupError as exc:
+            raise CommandError(str(exc))
+
+        covering = {}
+        for spec in options['cover']:
+            try:
+                app_label, model_name, field_name = spec.split('.')
+                model = apps.get_model(app_label, model_name)
+            except (ValueError, LookupError):
+                raise CommandError('Invalid --cover %r, expected APP_LABEL.MODEL.FIELD' % spec)
+            covering[model] = field_name
+
+        missing = {}
+        for model, gfk_field in gfk_models(app_configs):
+            report = inspect_gfk_indexes(
+                model,
+                gfk_field,
+                covering.get(model),
+                options['database'])
+
+            label = '%s.%s.%s' % (
+                model._meta.app_label,
+                model._meta.object_name,
+                gfk_field.name)
+            if report.usable:
+                self.stdout.write('%s: ok, indexed by %s' % (
+                    label, ', '.join(report.usable)))
+            else:
+                self.stdout.write('%s: missing index on (%s)' % (
+                    label, ', '.join(report.columns)))
+                missing.setdefault(model._meta.app_label, []).append(report)
+
+            for name in report.unused:
+                self.stdout.write('    unused: %s' % name)
+            for line in report.plan:
+                self.stdout.write('    plan: %s' % line)
+
+        for app_label, reports in sorted(missing.items()):
+            # the migration alone would be reverted by the next makemigrations
+            self.stdout.write('\n# Meta options for %s\n' % app_label)
+            for model, index_together in gfk_index_together(reports):
+                self.stdout.write('%s.Meta: index_together = %r' % (
+                    model._meta.object_name, index_together))
+            self.stdout.write('\n# migration for %s\n' % app_label)
+            self.stdout.write(gfk_index_migration(app_label, reports))
@@ -0,0 +1,18 @@
+from generic_aggregation.lazy import AggregateCollector
+
+
+class AggregateCollectorMiddleware(object):
+    """
+    Collect the lazy aggregates created while handling a request, so those
+    used when rendering the response are computed with a single query.
+    """
+    def process_request(self, request):
+        request.generic_aggregates = AggregateCollector()
+        request.generic_aggregates.activate()
+
+    def process_response(self, request, response):
+        # an earlier middleware may have returned a response before ours ran
+        collector = getattr(request, 'generic_aggregates', None)
+        if collector is not None:
+            collector.deactivate()
+        return response
@@ -0,0 +1,84 @@
+"""
+Assertions for testing code built on generic_aggregation:
+
+    from generic_aggregation.testing import GenericAggregationTestMixin
+
+    class FoodTests(GenericAggregationTestMixin, TestCase):
+        def test_listing(self):
+            foods = self.assertNumQueriesEvaluated(
+                1, generic_annotate, Food, Rating, Avg('ratings__rating'))
+"""
+
+import inspect
+import re
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet, RawQuerySet
+from django.test.utils import CaptureQueriesContext
+
+from generic_aggregation.indexes import explain
+
+
+def evaluate(result):
+    # querysets and generators are lazy, evaluate them so their queries count
+    if isinstance(result, (QuerySet, RawQuerySet)) or inspect.isgenerator(result):
+        return list(result)
+    return result
+
+def queryset_plan(qs):
+    """
+    Return the query plan of a queryset as a list of strings.
+    """
+    sql, params = qs.query.sql_with_params()
+    return explain(sql, params, qs.db)
+
+def full_scans(plan):
+    """
+    Return the tables a SQLite query plan reads in full, whether from the table
+    itself or from a covering index.
+    """
+    tables = []
+    for line in plan:
+        match = re.match(r'^SCAN (?:TABLE )?(\S+)', line)
+        if match:
+            tables.append(match.group(1))
+    return tables
+
+def temp_b_trees(plan):
+    """
+    Return the SQLite query plan lines sorting rows into a temporary b-tree.
+    """
+    return [line for line in plan if 'TEMP B-TREE' in line]
+
+
+class GenericAggregationTestMixin(object):
+    def assertNumQueriesEvaluated(self, num, func, *args, **kwargs):
+        """
+        Assert calling ``func`` and evaluating what it returns -- querysets and
+        generators included -- executes ``num`` queries.  Returns the result.
+        """
+        using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+        with CaptureQueriesContext(connections[using]) as context:
+            result = evaluate(func(*args, **kwargs))
+
+        executed = len(context)
+        self.assertEqual(executed, num, '%d queries executed, %d expected\n%s' % (
+            executed,
+            num,
+            '\n'.join(query['sql'] for query in context.captured_queries)))
+        return result
+
+    def assertNoFullScan(self, plan, *tables):
+        """
+        Assert a SQLite query plan does not read any of ``tables`` in full.
+        """
+        scanned = [table for table in full_scans(plan) if table in tables]
+        self.assertFalse(scanned, 'Full scan of %s:\n%s' % (
+            ', '.join(scanned), '\n'.join(plan)))
+
+    def assertNoTempBTree(self, plan):
+        """
+        Assert a SQLite query plan does not sort rows in a temporary b-tree.
+        """
+        sorts = temp_b_trees(plan)
+        self.assertFalse(sorts, 'Temporary b-tree sort:\n%s' % '\n'.join(plan))
@@ -2,29 +2,93 @@
 Django does not properly set up casts
 """
 
-import django
-from django.contrib.contenttypes.fields import GenericForeignKey
-from django.contrib.contenttypes.models import ContentType
-from django.db import connection
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.db.models.signals import post_migrate
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
+from django.db.models.sql import Query
 
 
-def get_gfk_field(model):
+def get_gfk_field(model, name=None):
+    # imported here so the package can be listed in INSTALLED_APPS
+    from django.contrib.contenttypes.fields import GenericForeignKey
+
     for field in model._meta.virtual_fields:
-        if isinstance(field, GenericForeignKey):
+        if isinstance(field, GenericForeignKey) and name in (None, field.name):
             return field
 
     raise ValueError('Unable to find gfk field on %s' % model)
 
+# content type ids keyed by (database alias, app label, model name).  unlike
+# ContentType's own cache these survive ContentType.objects.clear_cache(), so
+# are only looked up once per process
+_content_type_ids = {}
+
+def get_content_type_id(model, using=DEFAULT_DB_ALIAS):
+    opts = model._meta.concrete_model._meta
+    key = (using, opts.app_label, opts.model_name)
+    if key not in _content_type_ids:
+        warm_content_types([model], using)
+    return _content_type_ids[key]
+
+def get_gfk_target_models():
+    """
+    Return the models known to be the target of a GFK, i.e. those with a
+    GenericRelation.
+    """
+    from django.apps import apps
+    from django.contrib.contenttypes.fields import GenericRelation
+
+    return [
+        model for model in apps.get_models()
+        if any(isinstance(field, GenericRelation)
+               for field in model._meta.get_fields())]
+
+def warm_content_types(models=None, using=DEFAULT_DB_ALIAS):
+    """
+    Resolve and pin the content type ids of ``models`` with a single query,
+    by default those of every model with a GenericRelation.  Call this when a
+    worker process starts, e.g. in ``wsgi.py``, so that it is not the first
+    request on every worker which pays for the lookups:
+    
+        application = get_wsgi_application()
+        warm_content_types()
+    
+    :param models: a list of models, by default those with a GenericRelation
+    :param using: the database alias the content types are read from
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    if models is None:
+        models = get_gfk_target_models()
+    
+    content_types = ContentType.objects.db_manager(using).get_for_models(*models)
+    for model, content_type in content_types.items():
+        opts = model._meta.concrete_model._meta
+        _content_type_ids[using, opts.app_label, opts.model_name] = content_type.pk
+
+def clear_content_type_ids(**kwargs):
+    # migrating or flushing a database may renumber its content types
+    _content_type_ids.clear()
+
+post_migrate.connect(clear_content_type_ids, dispatch_uid='generic_aggregation.clear_content_type_ids')
+
 def normalize_qs_model(qs_or_model):
     if isinstance(qs_or_model, QuerySet):
         return qs_or_model
     return qs_or_model._default_manager.all()
 
-def get_field_type(f):
-    raw_type = f.db_type(connection)
-    if raw_type.lower().split()[0] in ('serial', 'integer', 'unsigned', 'bigint', 'smallint'):
+def get_field_type(f, using=DEFAULT_DB_ALIAS):
+    if f.get_internal_type() == 'UUIDField':
+        # stored as char(32) unless the database has a native uuid type
+        return 'uuid'
+    raw_type = f.db_type(connections[using])
+    base_type = raw_type.lower().split()[0].split('(')[0]
+    if base_type in ('serial', 'integer', 'unsigned', 'bigint', 'smallint'):
         raw_type = 'integer'
+    elif base_type in ('char', 'varchar', 'text', 'longtext'):
+        raw_type = 'text'
     return raw_type
 
 def generic_annotate(qs_model, generic_qs_model, aggregator, gfk_field=None, alias='score'):
@@ -114,164 +178,950 @@ def generic_filter(generic_qs_model, filter_qs_model, gfk_field=None):
     if not gfk_field:
         gfk_field = get_gfk_field(generic_qs.model)
     
-    pk_field_type = get_field_type(filter_qs.model._meta.pk)
-    gfk_field_type = get_field_type(generic_qs.model._meta.get_field(gfk_field.fk_field))
-    if pk_field_type != gfk_field_type:
+    pk_field_type = get_field_type(filter_qs.model._meta.pk, generic_qs.db)
+    gfk_field_type = get_field_type(generic_qs.model._meta.get_field(gfk_field.fk_field), generic_qs.db)
+    if pk_field_type != gfk_field_type or filter_qs.db != generic_qs.db:
         return fallback_generic_filter(generic_qs, filter_qs, gfk_field)
     
+    # filter on the inner query rather than the queryset, so pickling the
+    # result does not evaluate the subquery
     return generic_qs.filter(**{
-        gfk_field.ct_field: ContentType.objects.get_for_model(filter_qs.model),
-        '%s__in' % gfk_field.fk_field: filter_qs.values('pk'),
+        gfk_field.ct_field: get_content_type_id(filter_qs.model, generic_qs.db),
+        '%s__in' % gfk_field.fk_field: filter_qs.values('pk').query,
     })
 
 
-###############################################################################
-# fallback methods
+def generic_annotate_values(qs_model, generic_qs_model, aggregator, fields=None, gfk_field=None, alias='score', tuples=False):
+    """
+    Same as generic_annotate, but rather than model instances return a
+    ``values()`` queryset of dictionaries containing ``fields`` and the
+    annotation -- or a ``values_list()`` of tuples when ``tuples`` is True:
+    
+        qs = generic_annotate_values(Food, Rating, Avg('ratings__rating'), ['name'])
+        for row in qs.iterator():
+            print row['name'], row['score']
+    
+    :param fields: the fields to select, by default all the concrete fields
+    :param tuples: return tuples rather than dictionaries
+    :rtype: a values queryset
+    """
+    qs = generic_annotate(qs_model, generic_qs_model, aggregator, gfk_field, alias)
+    if fields:
+        fields = list(fields) + [alias]
+    else:
+        fields = [f.attname for f in qs.model._meta.concrete_fields] + [alias]
+    
+    if tuples:
+        return qs.values_list(*fields)
+    return qs.values(*fields)
 
-def query_as_sql(query):
-    return query.get_compiler(connection=connection).as_sql()
 
-def query_as_nested_sql(query):
-    return query.get_compiler(connection=connection).as_nested_sql()
+def generic_annotate_iterator(qs_model, generic_qs_model, aggregator, gfk_field=None, chunk_size=2000):
+    """
+    Iterate over ``(pk, value)`` 2-tuples, fetching ``chunk_size`` rows at a
+    time ordered by primary key, so memory use does not grow with the number
+    of objects:
+    
+        avg_ratings = dict(generic_annotate_iterator(Food, Rating, Avg('ratings__rating')))
+    
+    :rtype: a generator of 2-tuples
+    """
+    qs = generic_annotate_values(
+        normalize_qs_model(qs_model).order_by('pk'),
+        generic_qs_model,
+        aggregator,
+        ['pk'],
+        gfk_field,
+        alias='score',
+        tuples=True)
+    
+    chunk = qs
+    while True:
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        # continue after the last primary key seen rather than using OFFSET
+        chunk = qs.filter(pk__gt=rows[-1][0])
 
-def gfk_expression(qs_model, gfk_field):
-    # handle casting the GFK field if need be
+
+def generic_reduce(qs_model, generic_qs_model, reducer, fields, gfk_field=None, chunk_size=2000, processes=None):
+    """
+    Aggregate in Python what the database cannot, e.g. a median or a bayesian
+    average.  ``reducer`` is called to start each object's aggregate, which is
+    then given the values of every generic object in turn, like a sqlite3
+    aggregate:
+    
+        class BayesianAverage(object):
+            def __init__(self):
+                self.total, self.count = 0, 0
+            def step(self, rating):
+                self.total += rating
+                self.count += 1
+            def finalize(self):
+                return (3.0 * 10 + self.total) / (10 + self.count)
+        
+        scores = dict(generic_reduce(Food, Rating, BayesianAverage, ['rating']))
+    
+    The generic objects are read ``chunk_size`` rows at a time ordered by
+    object id, so memory use does not grow with the number of rows.  Objects
+    without generic objects are skipped.
+    
+    :param reducer: a callable returning an object with ``step()`` and
+        ``finalize()`` methods
+    :param fields: the fields of the generic model passed to ``step()``
+    :param processes: split the object ids in as many ranges, reduced in a
+        pool of processes.  Requires an integer object id and a picklable
+        reducer, and cannot be used inside a transaction
+    :rtype: a generator of ``(pk, value)`` 2-tuples
+    """
+    qs = normalize_qs_model(qs_model)
+    generic_qs = normalize_qs_model(generic_qs_model)
+    
+    if gfk_field is None:
+        gfk_field = get_gfk_field(generic_qs.model)
+    
+    generic_qs = generic_filter(generic_qs, qs, gfk_field)
+    fk_field = gfk_field.fk_field
+    
+    if not processes:
+        return reduce_rows(generic_qs, fk_field, qs.model, reducer, fields, chunk_size)
+    
+    fk_field_type = get_field_type(generic_qs.model._meta.get_field(fk_field), generic_qs.db)
+    if fk_field_type != 'integer':
+        raise ValueError('processes requires an integer object id')
+    if connections[generic_qs.db].in_atomic_block:
+        # the pool processes have their own connections, and would not see
+        # the changes made by the transaction
+        raise ValueError('processes cannot be used inside a transaction')
+    
+    return reduce_processes(generic_qs, fk_field, qs.model, reducer, fields, chunk_size, processes)
+
+def generic_rows(generic_qs, fk_field, fields, chunk_size):
+    """
+    Iterate over the ``(object_id, pk, *fields)`` tuples of the generic
+    objects, fetching ``chunk_size`` rows at a time.
+    """
+    from django.db.models import Q
+    
+    rows = generic_qs.values_list(fk_field, 'pk', *fields)
+    chunk = rows.order_by(fk_field, 'pk')
+    while True:
+        page = list(chunk[:chunk_size])
+        for row in page:
+            yield row
+        if len(page) < chunk_size:
+            break
+        # continue after the last row seen rather than using OFFSET
+        object_id, pk = page[-1][:2]
+        chunk = rows.filter(
+            Q(**{'%s__gt' % fk_field: object_id}) |
+            Q(**{fk_field: object_id, 'pk__gt': pk})).order_by(fk_field, 'pk')
+
+def reduce_rows(generic_qs, fk_field, model, reducer, fields, chunk_size):
+    pk_field = model._meta.pk
+    object_id = state = None
+    for row in generic_rows(generic_qs, fk_field, fields, chunk_size):
+        if state is None or row[0] != object_id:
+            if state is not None:
+                yield pk_field.to_python(object_id), state.finalize()
+            object_id, state = row[0], reducer()
+        state.step(*row[2:])
+    
+    if state is not None:
+        yield pk_field.to_python(object_id), state.finalize()
+
+# the connections a pool process inherited, kept so they are never closed
+_inherited_connections = []
+
+def reset_connections():
+    # runs in each pool process when it starts: the inherited connections are
+    # shared with the parent process, which closing them would break, so only
+    # forget them and let the process open its own
+    for alias in connections:
+        _inherited_connections.append(connections[alias])
+        del connections[alias]
+
+def reduce_range(task):
+    # runs in a pool process: rebuild the queryset from its pickled query
+    generic_model, query, using, fk_field, model, reducer, fields, chunk_size, first, last = task
+    generic_qs = generic_model._default_manager.using(using).all()
+    generic_qs.query = query
+    generic_qs = generic_qs.filter(**{
+        '%s__gte' % fk_field: first,
+        '%s__lt' % fk_field: last,
+    })
+    return list(reduce_rows(generic_qs, fk_field, model, reducer, fields, chunk_size))
+
+def reduce_processes(generic_qs, fk_field, model, reducer, fields, chunk_size, processes):
+    from multiprocessing import Pool
+    from django.db.models import Max, Min
+    
+    bounds = generic_qs.aggregate(first=Min(fk_field), last=Max(fk_field))
+    if bounds['first'] is None:
+        return
+    
+    # one range of object ids per process
+    step = (bounds['last'] - bounds['first']) // processes + 1
+    tasks = [
+        (generic_qs.model, generic_qs.query, generic_qs.db, fk_field, model,
+         reducer, fields, chunk_size, first, first + step)
+        for first in range(bounds['first'], bounds['last'] + 1, step)]
+    
+    pool = Pool(len(tasks), initializer=reset_connections)
+    try:
+        for results in pool.imap(reduce_range, tasks):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def generic_annotate_keyset(qs_model, generic_qs_model, aggregator, after=None, page_size=20, gfk_field=None, alias='score', descending=True):
+    """
+    Page through objects ordered by their annotation, seeking past the last
+    object of the previous page rather than using OFFSET, so deep pages cost
+    no more than the first one.  Ties are ordered by primary key, and objects
+    without a value (e.g. no ratings to average) come last:
+    
+        page = generic_annotate_keyset(Food, Rating, Avg('ratings__rating'))
+        last = page[-1]
+        next_page = generic_annotate_keyset(
+            Food, Rating, Avg('ratings__rating'), after=(last.score, last.pk))
+    
+    :param after: the ``(value, pk)`` 2-tuple of the last object of the
+        previous page, or None for the first page
+    :param page_size: the number of objects to return
+    :param alias: attribute name to use for annotation
+    :param descending: order by the highest values first
+    :rtype: a list of objects
+    """
+    qs = normalize_qs_model(qs_model)
+    using = qs.db
+    connection = connections[using]
     qn = connection.ops.quote_name
+    pk_field = qs.model._meta.pk
     
-    pk_field_type = get_field_type(qs_model._meta.pk)
-    gfk_field_type = get_field_type(gfk_field.model._meta.get_field(gfk_field.fk_field))
-    if 'mysql' in connection.settings_dict['ENGINE'] and pk_field_type == 'integer':
-        pk_field_type = 'unsigned'
+    # the annotated (value, pk) rows are computed once, in a derived table
+    values_qs = generic_annotate_values(
+        qs.order_by(), generic_qs_model, aggregator, ['pk'], gfk_field, alias, tuples=True)
+    inner_query, inner_query_params = query_as_sql(values_qs.query, using)
+    
+    value = 'generic_keyset.%s' % qn(alias)
+    pk = 'generic_keyset.%s' % qn(pk_field.column)
+    op, direction = ('<', 'DESC') if descending else ('>', 'ASC')
     
-    if pk_field_type != gfk_field_type:
-        # cast the gfk to the pk type
-        gfk_expr = "CAST(%s AS %s)" % (qn(gfk_field.fk_field), pk_field_type)
+    if after is None:
+        seek, seek_params = '', []
     else:
-        gfk_expr = qn(gfk_field.fk_field) # the object_id field on the GFK
+        # e.g. a UUID is compared with the column as stored
+        after_pk = pk_field.get_db_prep_value(after[1], connection)
+        if after[0] is None:
+            seek = 'WHERE %s IS NULL AND %s %s %%s' % (value, pk, op)
+            seek_params = [after_pk]
+        else:
+            seek = 'WHERE %s IS NULL OR %s %s %%s OR (%s = %%s AND %s %s %%s)' % (
+                value, value, op, value, pk, op)
+            seek_params = [after[0], after[0], after_pk]
+    
+    query = """
+        SELECT %s, %s FROM (%s) AS generic_keyset
+        %s
+        ORDER BY %s IS NULL, %s %s, %s %s
+        LIMIT %%s""" % (
+            pk,
+            value,
+            inner_query,
+            seek,
+            value,
+            value,
+            direction,
+            pk,
+            direction,
+        )
+    
+    cursor = connection.cursor()
+    cursor.execute(query, list(inner_query_params) + seek_params + [page_size])
+    # the raw pks are not converted, e.g. UUIDs come back as strings
+    rows = [(pk_field.to_python(obj_pk), obj_value) for obj_pk, obj_value in cursor.fetchall()]
     
-    return gfk_expr
+    objects = qs.in_bulk([row[0] for row in rows])
+    page = []
+    for obj_pk, obj_value in rows:
+        obj = objects[obj_pk]
+        setattr(obj, alias, obj_value)
+        page.append(obj)
+    return page
 
-def fallback_generic_annotate(qs_model, generic_qs_model, aggregator, gfk_field=None, alias='score'):
+
+def generic_update(qs_model, generic_qs_model, aggregator, field, gfk_field=None, batch_size=None):
+    """
+    Store the aggregate of every object in one of its fields, e.g. keep a
+    denormalized average rating up to date:
+    
+        generic_update(Food, Rating, Avg('ratings__rating'), 'avg_rating')
+        generic_update(Food, Rating, Count('ratings__rating'), 'rating_count')
+    
+    The objects are updated with set-based UPDATE statements rather than one
+    save() per object.  Objects without generic rows get the aggregate of no
+    rows, e.g. 0 for a count.
+    
+    :param field: the name of the field to update
+    :param batch_size: update objects in ranges of ``batch_size`` primary
+        keys, each in its own transaction, to limit how long rows are locked.
+        Requires an integer primary key
+    :rtype: the number of rows updated
+    """
+    from django.db import transaction
+    from django.db.models import Max, Min
+    
     qs = normalize_qs_model(qs_model)
     generic_qs = normalize_qs_model(generic_qs_model)
+    using = qs.db
     
-    content_type = ContentType.objects.get_for_model(qs.model)
+    if batch_size is None:
+        batches = [None]
+    else:
+        if get_field_type(qs.model._meta.pk, using) != 'integer':
+            raise ValueError('batch_size requires an integer primary key')
+        bounds = qs.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return 0
+        batches = [
+            (start, start + batch_size)
+            for start in range(bounds['first'], bounds['last'] + 1, batch_size)]
     
-    qn = connection.ops.quote_name
+    updated = 0
+    for batch in batches:
+        with transaction.atomic(using=using):
+            cursor = connections[using].cursor()
+            for query, query_params in generic_update_sql(
+                    qs, generic_qs, aggregator, field, gfk_field, batch):
+                cursor.execute(query, query_params)
+                updated += cursor.rowcount
+    return updated
+
 
-    if django.VERSION < (1, 8):
-        aggregate_field = aggregator.lookup
+def generic_aggregate_shards(qs_model, generic_qs_models, aggregator, gfk_field=None, threads=None):
+    """
+    Same as generic_aggregate, but for generic data split across several
+    tables or databases sharing the same GFK layout, e.g. ratings partitioned
+    by month:
+    
+        generic_aggregate_shards(Food, [
+            Rating.objects.using('ratings_2016_01'),
+            Rating.objects.using('ratings_2016_02'),
+            ArchivedRating,
+        ], Avg('ratings__rating'))
+    
+    The partial aggregate of each shard is computed in a pool of threads, and
+    the partials are then merged.  Count, Sum, Min, Max and Avg are supported,
+    the latter by summing and counting each shard.  An explicit ``gfk_field``
+    is matched by name against the GFKs of each shard's model.
+    
+    :param generic_qs_models: a list of models or querysets containing a GFK
+    :param threads: size of the thread pool, by default one thread per shard
+    :rtype: a scalar value indicating the result of the aggregation
+    """
+    from multiprocessing.pool import ThreadPool
+    
+    qs = normalize_qs_model(qs_model)
+    generic_querysets = [normalize_qs_model(m) for m in generic_qs_models]
+    partials, merge = shard_aggregates(aggregator)
+    if not generic_querysets:
+        # nothing to aggregate, and a pool needs at least one thread
+        return merge([])
+    
+    def aggregate_shard(generic_qs):
+        # the shards may be different models, find the GFK of each by name
+        shard_gfk_field = get_gfk_field(
+            generic_qs.model, gfk_field.name if gfk_field else None)
+        query, query_params = generic_aggregate_sql(qs, generic_qs, partials, shard_gfk_field)
+        try:
+            cursor = connections[generic_qs.db].cursor()
+            cursor.execute(query, query_params)
+            return cursor.fetchone()
+        finally:
+            # connections are per-thread, don't leave the pool's ones open
+            connections[generic_qs.db].close()
+            if qs.db != generic_qs.db:
+                connections[qs.db].close()
+    
+    pool = ThreadPool(threads or len(generic_querysets))
+    try:
+        results = pool.map(aggregate_shard, generic_querysets)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return merge(results)
+
+def shard_aggregates(aggregator):
+    """
+    Return the aggregates to compute on every shard, and a function merging
+    the list of the per-shard results into the final value.
+    """
+    from django.db.models import Count, Sum
+    
+    if aggregator.extra.get('distinct'):
+        raise ValueError('Distinct aggregates cannot be merged across shards')
+    
+    source = aggregator.get_source_expressions()[0]
+    
+    def values(results, idx=0):
+        return [result[idx] for result in results if result[idx] is not None]
+    
+    name = aggregator.name.upper()
+    if name == 'COUNT':
+        def merge(results):
+            return sum(values(results))
+    elif name == 'SUM':
+        def merge(results):
+            totals = values(results)
+            return sum(totals) if totals else None
+    elif name == 'MIN':
+        def merge(results):
+            return min(values(results) or [None])
+    elif name == 'MAX':
+        def merge(results):
+            return max(values(results) or [None])
+    elif name == 'AVG':
+        def merge(results):
+            count = sum(values(results, 1))
+            if not count:
+                return None
+            return float(sum(values(results, 0))) / count
+        return [Sum(source), Count(source)], merge
     else:
-        aggregate_field = aggregator.default_alias.rsplit('__', 1)[0]
+        raise ValueError('Unable to merge %s aggregates across shards' % aggregator.name)
+    
+    return [aggregator], merge
+
+
+def generic_annotate_top(qs_model, generic_qs_model, count, order_by, gfk_field=None, alias='top'):
+    """
+    Fetch the first ``count`` generic objects of every object, e.g. the latest
+    3 ratings of each food, using a single query rather than one per object:
+    
+        foods = generic_annotate_top(Food.objects.all()[:20], Rating, 3, ['-created'])
+        for food in foods:
+            print food.name, [rating.rating for rating in food.top]
+    
+    On Postgres this is a LATERAL join, elsewhere the rows are ranked with the
+    ROW_NUMBER() window function.
+    
+    :param qs_model: A model or a queryset of objects you want to perform
+        annotation on, e.g. foods
+    :param generic_qs_model: A model or queryset containing a GFK, e.g. ratings
+    :param count: the number of generic objects to fetch per object
+    :param order_by: a list of field names of the generic model, optionally
+        prefixed with "-" for descending order, e.g. ['-created']
+    :param gfk_field: explicitly specify the field w/the gfk
+    :param alias: attribute name holding the list of generic objects
+    :rtype: a list of objects
+    """
+    objects = list(normalize_qs_model(qs_model))
+    if not objects:
+        return objects
+    
+    generic_qs = normalize_qs_model(generic_qs_model)
+    if gfk_field is None:
+        gfk_field = get_gfk_field(generic_qs.model)
+    
+    query, query_params = generic_top_sql(
+        objects, generic_qs, count, order_by, gfk_field)
+    rows = generic_qs.model._default_manager.db_manager(generic_qs.db).raw(
+        query, query_params)
+    
+    pk_field = objects[0]._meta.pk
+    related = {}
+    for row in rows:
+        object_id = pk_field.to_python(getattr(row, gfk_field.fk_field))
+        related.setdefault(object_id, []).append(row)
+    
+    for obj in objects:
+        # the rows are ranked by the query, but not returned in rank order
+        top = sorted(related.get(obj.pk, []), key=lambda row: row.generic_rank)
+        setattr(obj, alias, top)
+    return objects
 
-    # since the aggregate may contain a generic relation, strip it
-    if '__' in aggregate_field:
-        _, aggregate_field = aggregate_field.rsplit('__', 1)
+
+###############################################################################
+# fallback methods
+
+def query_as_sql(query, using=DEFAULT_DB_ALIAS):
+    return query.get_compiler(using=using).as_sql()
+
+def query_as_nested_sql(query, using=DEFAULT_DB_ALIAS):
+    return query.get_compiler(using=using).as_nested_sql()
+
+def target_pks_sql(qs, gfk_field, using=DEFAULT_DB_ALIAS):
+    """
+    Return SQL (and params) selecting the primary keys of ``qs``, as stored in
+    the GFK, in a query run on the ``using`` database.  When ``qs`` lives on
+    another database the keys are fetched and passed as parameters instead.
+    """
+    if qs.db == using:
+        query, params = query_as_nested_sql(qs.values_list('pk').query, using)
+        column = 'generic_pks.%s' % connections[using].ops.quote_name(qs.model._meta.pk.column)
+        expression = pk_expression(qs.model, gfk_field, column, using)
+        if expression is not None and expression != column:
+            query = 'SELECT %s FROM (%s) AS generic_pks' % (expression, query)
+        return query, params
+    
+    pks = gfk_params(qs.model, gfk_field, qs.values_list('pk', flat=True), using)
+    if not pks:
+        return 'NULL', []
+    return ', '.join(['%s'] * len(pks)), pks
+
+def pk_expression(qs_model, gfk_field, column, using=DEFAULT_DB_ALIAS):
+    """
+    Convert ``column``, SQL referencing the primary key of ``qs_model``, to the
+    value the GFK stores, e.g. '42' in a text object id for the primary key 42,
+    so the GFK column is compared as it is and its index can be used.  Returns
+    None when the primary key cannot be converted, and the GFK column is cast
+    instead.
+    """
+    connection = connections[using]
+    
+    pk_field_type = get_field_type(qs_model._meta.pk, using)
+    gfk_field_type = get_field_type(gfk_field.model._meta.get_field(gfk_field.fk_field), using)
+    if pk_field_type == gfk_field_type:
+        return column
+    elif gfk_field_type != 'text':
+        return None
+    
+    if pk_field_type == 'integer':
+        return 'CAST(%s AS %s)' % (column, 'char' if connection.vendor == 'mysql' else 'text')
+    elif pk_field_type == 'uuid':
+        if connection.features.has_native_uuid_field:
+            return 'CAST(%s AS text)' % column
+        # the GFK holds str(uuid), hyphenated, the column the 32 hex digits
+        parts = ['SUBSTR(%s, %s, %s)' % (column, start, length)
+                 for start, length in ((1, 8), (9, 4), (13, 4), (17, 4), (21, 12))]
+        if connection.vendor == 'mysql':
+            return "CONCAT_WS('-', %s)" % ', '.join(parts)
+        return " || '-' || ".join(parts)
+    return None
+
+def gfk_params(qs_model, gfk_field, pks, using=DEFAULT_DB_ALIAS):
+    """
+    Convert primary keys of ``qs_model`` to query params compared with the GFK.
+    """
+    if pk_expression(qs_model, gfk_field, 'pk', using) is None:
+        return list(pks)
+    fk_field = gfk_field.model._meta.get_field(gfk_field.fk_field)
+    return [fk_field.get_db_prep_value(fk_field.to_python(pk), connections[using])
+            for pk in pks]
+
+def gfk_expression(qs_model, gfk_field, using=DEFAULT_DB_ALIAS):
+    # handle casting the GFK field if need be
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    
+    if pk_expression(qs_model, gfk_field, 'pk', using) is not None:
+        # primary keys are converted instead, see pk_expression
+        return qn(gfk_field.fk_field) # the object_id field on the GFK
+    
+    pk_field_type = qs_model._meta.pk.db_type(connection)
+    if connection.vendor == 'mysql' and get_field_type(qs_model._meta.pk, using) == 'integer':
+        pk_field_type = 'unsigned'
+    
+    # cast the gfk to the pk type
+    return "CAST(%s AS %s)" % (qn(gfk_field.fk_field), pk_field_type)
+
+def generic_expression(model, expression):
+    """
+    Rewrite the field references of an expression, which are relative to the
+    queried model (e.g. ``ratings__rating``), to be relative to the generic
+    model instead (``rating``).
+    """
+    if isinstance(expression, F):
+        # since the aggregate may contain a generic relation, strip it
+        relation, _, lookup = expression.name.partition('__')
+        if lookup:
+            try:
+                model._meta.get_field(relation)
+            except FieldDoesNotExist:
+                return F(lookup)
+        return expression
+    
+    if not hasattr(expression, 'get_source_expressions'):
+        return expression
+    
+    expression = expression.copy()
+    expression.set_source_expressions([
+        generic_expression(model, source)
+        for source in expression.get_source_expressions()])
+    return expression
+
+def aggregate_sql(generic_model, aggregator, using=DEFAULT_DB_ALIAS):
+    """
+    Compile the aggregate to SQL selecting from the generic model's table, so
+    options like ``distinct`` and arithmetic on columns are kept intact.
+    """
+    query = Query(generic_model)
+    base_alias = query.get_initial_alias()
+    expression = generic_expression(generic_model, aggregator).resolve_expression(
+        query, allow_joins=True, reuse=None, summarize=False)
+    
+    if any(query.alias_refcount[alias] for alias in query.alias_map
+           if alias != base_alias):
+        raise ValueError('Aggregates on fields of related models are not '
+                         'supported: %r' % aggregator)
+    
+    sql, params = query.get_compiler(using=using).compile(expression)
+    return sql, list(params)
+
+def generic_where_sql(generic_qs):
+    """
+    Return the SQL and params restricting a query on the GFK table to the rows
+    of ``generic_qs``.  Where possible the generic queryset's own WHERE clause
+    is used as-is, so the GFK table is read once rather than a second time by a
+    ``pk IN (<generic query>)`` subquery.
+    """
+    # a LIMIT, DISTINCT or extra table changes which rows the generic
+    # queryset returns, and has no place in the WHERE clause
+    restricted = (
+        generic_qs.query.low_mark or
+        generic_qs.query.high_mark is not None or
+        generic_qs.query.distinct or
+        generic_qs.query.extra_tables)
+    if not restricted and not generic_qs.query.where.children:
+        return '', []
+    
+    qn = connections[generic_qs.db].ops.quote_name
+    opts = generic_qs.model._meta
+    
+    query = generic_qs.query.clone()
+    base_alias = query.get_initial_alias()
+    where, params = query.get_compiler(using=generic_qs.db).compile(query.where)
+    
+    # conditions on related tables refer to joins which will not be there
+    joined = [alias for alias in query.alias_map
+              if alias != base_alias and query.alias_refcount[alias]]
+    if not restricted and not joined and base_alias == opts.db_table:
+        if not where:
+            return '', []
+        return ' AND %s' % where, list(params)
+    
+    generic_query = generic_qs.values_list('pk').query
+    inner_query, inner_query_params = query_as_sql(generic_query, generic_qs.db)
+    if generic_qs.query.low_mark or generic_qs.query.high_mark is not None:
+        # MySQL does not support LIMIT in an IN subquery, only in a derived table
+        inner_query = 'SELECT %s FROM (%s) AS generic_sliced' % (
+            qn(opts.pk.column),
+            inner_query,
+        )
+    where = ' AND %s.%s IN (%s)' % (
+        qn(opts.db_table),
+        qn(opts.pk.column),
+        inner_query,
+    )
+    return where, list(inner_query_params)
+
+def order_by_sql(model, order_by, using=DEFAULT_DB_ALIAS):
+    qn = connections[using].ops.quote_name
+    opts = model._meta
+    
+    ordering = []
+    for name in list(order_by) + ['pk']:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        field = opts.pk if name == 'pk' else opts.get_field(name)
+        ordering.append('%s.%s%s' % (
+            qn(opts.db_table),
+            qn(field.column),
+            ' DESC' if descending else ''))
+    return ', '.join(ordering)
+
+def generic_top_sql(objects, generic_qs, count, order_by, gfk_field):
+    """
+    Return the SQL and params selecting, for each of ``objects``, the first
+    ``count`` rows of ``generic_qs`` ordered by ``order_by``.
+    """
+    using = generic_qs.db
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    
+    model = type(objects[0])
+    table = qn(gfk_field.model._meta.db_table)
+    gfk_expr = gfk_expression(model, gfk_field, using)
+    where, where_params = generic_where_sql(generic_qs)
+    
+    pks = gfk_params(model, gfk_field, [obj.pk for obj in objects], using)
+    content_type_id = get_content_type_id(model, using)
+    
+    ordering = order_by_sql(gfk_field.model, order_by, using)
+    
+    if connection.vendor == 'postgresql':
+        # run the ordered, limited query once per object
+        query = """
+            SELECT generic_top.* FROM (VALUES %s) AS generic_targets (pk)
+            CROSS JOIN LATERAL (
+                SELECT %s.*, ROW_NUMBER() OVER (ORDER BY %s) AS generic_rank
+                FROM %s
+                WHERE
+                    %s.%s=%%s AND
+                    %s=generic_targets.pk%s
+                ORDER BY %s
+                LIMIT %%s
+            ) AS generic_top""" % (
+                ', '.join(['(%s)'] * len(pks)),
+                table,
+                ordering,
+                table,
+                table,
+                qn(gfk_field.ct_field + '_id'),
+                gfk_expr,
+                where,
+                ordering,
+            )
+        return query, pks + [content_type_id] + where_params + [count]
+    
+    query = """
+        SELECT * FROM (
+            SELECT %s.*, ROW_NUMBER() OVER (
+                PARTITION BY %s ORDER BY %s) AS generic_rank
+            FROM %s
+            WHERE
+                %s.%s=%%s AND
+                %s IN (%s)%s
+        ) AS generic_ranked
+        WHERE generic_rank <= %%s""" % (
+            table,
+            gfk_expr,
+            ordering,
+            table,
+            table,
+            qn(gfk_field.ct_field + '_id'),
+            gfk_expr,
+            ', '.join(['%s'] * len(pks)),
+            where,
+        )
+    return query, [content_type_id] + pks + where_params + [count]
+
+def generic_annotate_sql(qs_model, generic_qs_model, aggregator, gfk_field=None):
+    """
+    Return the SQL and params of the subquery fallback_generic_annotate selects,
+    which aggregates the generic rows of the current row of the queried table.
+    """
+    qs = normalize_qs_model(qs_model)
+    generic_qs = normalize_qs_model(generic_qs_model)
+    
+    # the aggregate is a subquery of the annotated query, so they share a db
+    using = qs.db
+    if generic_qs.db != using:
+        generic_qs = generic_qs.using(using)
+    
+    content_type_id = get_content_type_id(qs.model, using)
+    
+    qn = connections[using].ops.quote_name
     
     if gfk_field is None:
         gfk_field = get_gfk_field(generic_qs.model)
     
+    aggregate, aggregate_params = aggregate_sql(gfk_field.model, aggregator, using)
+    
+    # the table and pk from the main part of the query
+    pk = '%s.%s' % (qn(qs.model._meta.db_table), qn(qs.model._meta.pk.column))
+    
     # collect the params we'll be using
     params = (
-        aggregator.name, # the function that's doing the aggregation
-        qn(aggregate_field), # the field containing the value to aggregate
+        aggregate, # the aggregation, e.g. COUNT(DISTINCT "rating"."rating")
         qn(gfk_field.model._meta.db_table), # table holding gfk'd item info
         qn(gfk_field.ct_field + '_id'), # the content_type field on the GFK
-        content_type.pk, # the content_type id we need to match
-        gfk_expression(qs.model, gfk_field),
-        qn(qs.model._meta.db_table), # the table and pk from the main
-        qn(qs.model._meta.pk.name)   # part of the query
+        gfk_expression(qs.model, gfk_field, using),
+        pk_expression(qs.model, gfk_field, pk, using) or pk,
     )
     
     sql_template = """
-        SELECT %s(%s) AS aggregate_score
+        SELECT %s AS aggregate_score
         FROM %s
         WHERE
-            %s=%s AND
-            %s=%s.%s"""
-    
-    extra = sql_template % params
+            %s=%%s AND
+            %s=%s"""
     
-    if generic_qs.query.where.children:
-        generic_query = generic_qs.values_list('pk').query
-        inner_query, inner_query_params = query_as_sql(generic_query)
-        
-        inner_params = (
-            qn(generic_qs.model._meta.db_table),
-            qn(generic_qs.model._meta.pk.name),
-        )
-        inner_start = ' AND %s.%s IN (' % inner_params
-        inner_end = ')'
-        extra = extra + inner_start + inner_query + inner_end
-    else:
-        inner_query_params = []
+    where, where_params = generic_where_sql(generic_qs)
+    return sql_template % params + where, aggregate_params + [content_type_id] + where_params
+
+def fallback_generic_annotate(qs_model, generic_qs_model, aggregator, gfk_field=None, alias='score'):
+    qs = normalize_qs_model(qs_model)
+    extra, extra_params = generic_annotate_sql(qs, generic_qs_model, aggregator, gfk_field)
 
     return qs.extra(
         select={alias: extra},
-        select_params=inner_query_params,
+        select_params=extra_params,
     )
 
-def fallback_generic_aggregate(qs_model, generic_qs_model, aggregator, gfk_field=None):
+def generic_update_sql(qs_model, generic_qs_model, aggregator, field, gfk_field=None, pk_range=None):
+    """
+    Return a list of (SQL, params) 2-tuples of the statements generic_update
+    runs, optionally restricted to the primary keys in ``pk_range``.
+    """
     qs = normalize_qs_model(qs_model)
     generic_qs = normalize_qs_model(generic_qs_model)
+    using = qs.db
+    if generic_qs.db != using:
+        generic_qs = generic_qs.using(using)
     
-    content_type = ContentType.objects.get_for_model(qs.model)
-    
+    connection = connections[using]
     qn = connection.ops.quote_name
+    
+    if gfk_field is None:
+        gfk_field = get_gfk_field(generic_qs.model)
+    
+    opts = qs.model._meta
+    table = qn(opts.db_table)
+    pk = '%s.%s' % (table, qn(opts.pk.column))
+    column = qn(opts.get_field(field).column)
+    
+    # restrict the update to the objects of the queryset
+    conditions, condition_params = [], []
+    if qs.query.where.children:
+        inner_query, inner_query_params = query_as_nested_sql(
+            qs.values_list('pk').query, using)
+        if connection.vendor == 'mysql':
+            # mysql will not read the updated table in a subquery, unless the
+            # subquery is materialized
+            inner_query = 'SELECT * FROM (%s) AS generic_pks' % inner_query
+        conditions.append('%s IN (%s)' % (pk, inner_query))
+        condition_params.extend(inner_query_params)
+    if pk_range is not None:
+        conditions.append('%s >= %%s AND %s < %%s' % (pk, pk))
+        condition_params.extend(pk_range)
+    
+    if connection.vendor != 'postgresql':
+        # correlated subquery, evaluated for each updated row
+        subquery, subquery_params = generic_annotate_sql(qs, generic_qs, aggregator, gfk_field)
+        query = 'UPDATE %s SET %s = (%s)' % (table, column, subquery)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [(query, subquery_params + condition_params)]
+    
+    # aggregate the generic table in a single pass, grouping by object
+    generic_table = qn(gfk_field.model._meta.db_table)
+    ct_column = qn(gfk_field.ct_field + '_id')
+    gfk_expr = gfk_expression(qs.model, gfk_field, using)
+    pk_expr = pk_expression(qs.model, gfk_field, pk, using) or pk
+    content_type_id = get_content_type_id(qs.model, using)
+    aggregate, aggregate_params = aggregate_sql(gfk_field.model, aggregator, using)
+    where, where_params = generic_where_sql(generic_qs)
+    
+    # only aggregate the generic rows of the batch, which the object ids can
+    # be compared with when they are stored like the primary key
+    grouped_where, grouped_params = where, list(where_params)
+    if pk_range is not None and pk_expr == pk:
+        grouped_where += ' AND %s >= %%s AND %s < %%s' % (gfk_expr, gfk_expr)
+        grouped_params.extend(pk_range)
+    
+    grouped_query = """
+        UPDATE %s SET %s = generic_grouped.value
+        FROM (
+            SELECT %s AS object_id, %s AS value
+            FROM %s
+            WHERE %s=%%s%s
+            GROUP BY %s
+        ) AS generic_grouped
+        WHERE %s""" % (
+            table,
+            column,
+            gfk_expr,
+            aggregate,
+            generic_table,
+            ct_column,
+            grouped_where,
+            gfk_expr,
+            ' AND '.join(['%s = generic_grouped.object_id' % pk_expr] + conditions),
+        )
+    grouped_params = aggregate_params + [content_type_id] + grouped_params + condition_params
+    
+    # objects without any generic rows get the aggregate of no rows
+    empty_query = """
+        UPDATE %s SET %s = (SELECT %s FROM %s WHERE 1 = 0)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM %s
+            WHERE %s=%%s AND %s=%s%s
+        )""" % (
+            table,
+            column,
+            aggregate,
+            generic_table,
+            generic_table,
+            ct_column,
+            gfk_expr,
+            pk_expr,
+            where,
+        )
+    if conditions:
+        empty_query += ' AND ' + ' AND '.join(conditions)
+    empty_params = aggregate_params + [content_type_id] + where_params + condition_params
+    
+    return [(grouped_query, grouped_params), (empty_query, empty_params)]
 
-    if django.VERSION < (1, 8):
-        aggregate_field = aggregator.lookup
-    else:
-        aggregate_field = aggregator.default_alias.rsplit('__', 1)[0]
+def generic_aggregate_sql(qs_model, generic_qs_model, aggregator, gfk_field=None):
+    """
+    Return the SQL and params of the query fallback_generic_aggregate runs,
+    which is to be executed on the generic queryset's database.  Given a list
+    of aggregators, the query selects each of them.
+    """
+    qs = normalize_qs_model(qs_model)
+    generic_qs = normalize_qs_model(generic_qs_model)
+    using = generic_qs.db
     
-    # since the aggregate may contain a generic relation, strip it
-    if '__' in aggregate_field:
-        _, aggregate_field = aggregate_field.rsplit('__', 1)
+    content_type_id = get_content_type_id(qs.model, using)
+    
+    qn = connections[using].ops.quote_name
     
     if gfk_field is None:
         gfk_field = get_gfk_field(generic_qs.model)
     
-    qs = qs.values_list('pk') # just the pks
-    query, query_params = query_as_nested_sql(qs.query)
+    if isinstance(aggregator, (list, tuple)):
+        aggregators = aggregator
+    else:
+        aggregators = [aggregator]
+    
+    aggregates, aggregate_params = [], []
+    for idx, aggregator in enumerate(aggregators):
+        sql, params = aggregate_sql(gfk_field.model, aggregator, using)
+        alias = 'aggregate_score_%d' % idx if len(aggregators) > 1 else 'aggregate_score'
+        aggregates.append('%s AS %s' % (sql, alias))
+        aggregate_params.extend(params)
+    aggregate = ', '.join(aggregates)
+    
+    query, query_params = target_pks_sql(qs, gfk_field, using) # just the pks
     
     # collect the params we'll be using
     params = (
-        aggregator.name, # the function that's doing the aggregation
-        qn(aggregate_field), # the field containing the value to aggregate
+        aggregate, # the aggregation, e.g. COUNT(DISTINCT "rating"."rating")
         qn(gfk_field.model._meta.db_table), # table holding gfk'd item info
         qn(gfk_field.ct_field + '_id'), # the content_type field on the GFK
-        content_type.pk, # the content_type id we need to match
-        gfk_expression(qs.model, gfk_field), # the object_id field on the GFK
+        gfk_expression(qs.model, gfk_field, using), # the object_id field on the GFK
     )
     
     query_start = """
-        SELECT %s(%s) AS aggregate_score
+        SELECT %s
         FROM %s
         WHERE
-            %s=%s AND
+            %s=%%s AND
             %s IN (
                 """ % params
     
-    query_end = ")"
-    
-    if generic_qs.query.where.children:
-        generic_query = generic_qs.values_list('pk').query
-        inner_query, inner_query_params = query_as_sql(generic_query)
-        
-        query_params += inner_query_params
-        
-        inner_params = (
-            qn(generic_qs.model._meta.pk.name),
-        )
-        inner_start = ' AND %s IN (' % inner_params
-        inner_end = ')'
-        query_end = query_end + inner_start + inner_query + inner_end
+    where, where_params = generic_where_sql(generic_qs)
+    query_end = ")" + where
+    query_params = aggregate_params + [content_type_id] + list(query_params) + where_params
     
     # pass in the inner_query unmodified as we will use the cursor to handle
     # quoting the inner parameters correctly
-    query = query_start + query + query_end
+    return query_start + query + query_end, query_params
+
+def fallback_generic_aggregate(qs_model, generic_qs_model, aggregator, gfk_field=None):
+    generic_qs = normalize_qs_model(generic_qs_model)
+    query, query_params = generic_aggregate_sql(qs_model, generic_qs, aggregator, gfk_field)
     
-    cursor = connection.cursor()
+    cursor = connections[generic_qs.db].cursor()
     cursor.execute(query, query_params)
     row = cursor.fetchone()
 
@@ -286,17 +1136,17 @@ def fallback_generic_filter(generic_qs_model, filter_qs_model, gfk_field=None):
     
     # get the contenttype of our filtered queryset, e.g. Business
     filter_model = filter_qs.model
-    content_type = ContentType.objects.get_for_model(filter_model)
+    using = generic_qs.db
+    content_type_id = get_content_type_id(filter_model, using)
     
     # filter the generic queryset to only include items of the given ctype
-    generic_qs = generic_qs.filter(**{gfk_field.ct_field: content_type})
+    generic_qs = generic_qs.filter(**{gfk_field.ct_field: content_type_id})
     
     # just select the primary keys in the sub-select
-    filtered_query = filter_qs.values_list('pk').query
-    inner_query, inner_query_params = query_as_sql(filtered_query)
+    inner_query, inner_query_params = target_pks_sql(filter_qs, gfk_field, using)
     
     where = '%s IN (%s)' % (
-        gfk_expression(filter_model, gfk_field),
+        gfk_expression(filter_model, gfk_field, using),
         inner_query,
     )
     
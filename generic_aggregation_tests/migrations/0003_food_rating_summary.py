@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 21:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generic_aggregation_tests', '0002_rating_gfk_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='food',
+            name='avg_rating',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='food',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 21:52
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('generic_aggregation_tests', '0004_uuid_models'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRating',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rating', models.IntegerField()),
+                ('created', models.DateTimeField(default=datetime.datetime.now)),
+                ('object_id', models.IntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedrating',
+            index_together=set([('content_type', 'object_id', 'rating')]),
+        ),
+    ]
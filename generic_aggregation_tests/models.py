@@ -1,4 +1,5 @@
 import datetime
+import uuid
 
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
@@ -11,11 +12,27 @@ class Rating(models.Model):
     object_id = models.IntegerField()
     content_type = models.ForeignKey(ContentType)
     content_object = GenericForeignKey(ct_field='content_type', fk_field='object_id')
+
+    class Meta:
+        index_together = [('content_type', 'object_id', 'rating')]
     
     def __unicode__(self):
         return '%s rated %s' % (self.content_object, self.rating)
 
 
+class ArchivedRating(models.Model):
+    # same layout as Rating, e.g. the ratings of past years moved to their
+    # own table
+    rating = models.IntegerField()
+    created = models.DateTimeField(default=datetime.datetime.now)
+    object_id = models.IntegerField()
+    content_type = models.ForeignKey(ContentType)
+    content_object = GenericForeignKey(ct_field='content_type', fk_field='object_id')
+
+    class Meta:
+        index_together = [('content_type', 'object_id', 'rating')]
+
+
 class CharFieldGFK(models.Model):
     name = models.CharField(max_length=255)
     object_id = models.TextField()
@@ -25,9 +42,32 @@ class CharFieldGFK(models.Model):
 
 class Food(models.Model):
     name = models.CharField(max_length=100)
+    avg_rating = models.FloatField(null=True)
+    rating_count = models.IntegerField(default=0)
     
     ratings = GenericRelation(Rating)
     char_gfk = GenericRelation(CharFieldGFK)
 
     def __unicode__(self):
         return self.name
+
+
+class UUIDRating(models.Model):
+    rating = models.IntegerField()
+    object_id = models.UUIDField()
+    content_type = models.ForeignKey(ContentType)
+    content_object = GenericForeignKey(ct_field='content_type', fk_field='object_id')
+
+    class Meta:
+        index_together = [('content_type', 'object_id', 'rating')]
+
+
+class UUIDFood(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    name = models.CharField(max_length=100)
+
+    ratings = GenericRelation(UUIDRating)
+    char_gfk = GenericRelation(CharFieldGFK)
+
+    def __unicode__(self):
+        return self.name
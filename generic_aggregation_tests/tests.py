@@ -1,16 +1,55 @@
 import datetime
+import random
+from unittest import skipIf, skipUnless
 
+from django.apps import apps
 from django.conf import settings
-from django.db import models
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldError
+from django.core.management import call_command
+from django.db import connection, connections, models
+from django.db.models import F
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
 
 from generic_aggregation import generic_annotate as _generic_annotate, generic_aggregate as _generic_aggregate, generic_filter as _generic_filter
+from generic_aggregation import generic_aggregate_shards, generic_annotate_iterator, generic_annotate_keyset
+from generic_aggregation import generic_annotate_top, generic_annotate_values, generic_reduce, generic_update
+from generic_aggregation.indexes import check_gfk_indexes, explain, inspect_gfk_indexes
+from generic_aggregation.testing import GenericAggregationTestMixin, queryset_plan
+from generic_aggregation import warm_content_types
+from generic_aggregation import AggregateCollector, lazy_generic_aggregate
+from generic_aggregation.lazy import get_collector
+from generic_aggregation.middleware import AggregateCollectorMiddleware
 from generic_aggregation.utils import fallback_generic_annotate, fallback_generic_aggregate, fallback_generic_filter
+from generic_aggregation.utils import clear_content_type_ids, generic_aggregate_sql, generic_annotate_sql, generic_top_sql, get_gfk_field
 from generic_aggregation_tests.models import (
-    Food, Rating, CharFieldGFK
+    ArchivedRating, Food, Rating, CharFieldGFK, UUIDFood, UUIDRating
 )
 
-class SimpleTest(TestCase):
+# explain() and the plan assertions only understand SQLite's query plans
+sqlite_plans = skipUnless(connection.vendor == 'sqlite', 'query plans are checked on SQLite')
+
+
+class Median(object):
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        self.values.append(value)
+
+    def finalize(self):
+        values = sorted(self.values)
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+
+class RatingTestCase(TestCase):
     PAST_DATE = datetime.datetime(2010, 1, 1)
 
     def setUp(self):
@@ -30,6 +69,8 @@ class SimpleTest(TestCase):
         Rating.objects.create(content_object=self.orange, rating=8,
                               created=self.PAST_DATE)
 
+
+class SimpleTest(RatingTestCase):
     def generic_annotate(self, *args, **kwargs):
         return _generic_annotate(*args, **kwargs)
 
@@ -153,6 +194,71 @@ class SimpleTest(TestCase):
         aggregated = self.generic_aggregate(Food.objects.all(), todays_ratings, models.Count('ratings__rating'))
         self.assertEqual(aggregated, 4)
 
+    def test_subset_single_scan(self):
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        with CaptureQueriesContext(connection) as ctx:
+            list(self.generic_annotate(Food, todays_ratings, models.Sum('ratings__rating')))
+            self.generic_aggregate(Food, todays_ratings, models.Sum('ratings__rating'))
+
+        rating_table = 'FROM %s' % connection.ops.quote_name(Rating._meta.db_table)
+        queries = [q['sql'] for q in ctx.captured_queries if 'aggregate_score' in q['sql']]
+        self.assertEqual(len(queries), 2)
+        for sql in queries:
+            self.assertEqual(sql.count(rating_table), 1)
+
+    def test_subset_joined(self):
+        food_ratings = Rating.objects.filter(content_type__model='food', rating__gte=4)
+        aggregated = self.generic_aggregate(Food, food_ratings, models.Count('ratings__rating'))
+        self.assertEqual(aggregated, 3)
+
+        annotated_qs = self.generic_annotate(Food, food_ratings, models.Count('ratings__rating'))
+        self.assertEqual(
+            {'apple': 1, 'orange': 2, 'peach': 0},
+            {food.name: food.score for food in annotated_qs})
+
+    def test_subset_sliced(self):
+        # the two best ratings, 8 on orange and 5 on apple
+        best_ratings = Rating.objects.filter(rating__gte=1).order_by('-rating')[:2]
+        aggregated = self.generic_aggregate(Food, best_ratings, models.Sum('ratings__rating'))
+        self.assertEqual(aggregated, 13)
+
+        annotated_qs = self.generic_annotate(Food, best_ratings, models.Sum('ratings__rating'))
+        self.assertEqual(
+            {'apple': 5, 'orange': 8, 'peach': None},
+            {food.name: food.score for food in annotated_qs})
+
+    def test_distinct_aggregates(self):
+        distinct_ratings = models.Count('ratings__rating', distinct=True)
+        annotated_qs = self.generic_annotate(Food, Rating, distinct_ratings)
+        self.assertEqual(
+            {'apple': 3, 'orange': 3, 'peach': 0},
+            {food.name: food.score for food in annotated_qs})
+
+        aggregated = self.generic_aggregate(Food, Rating, distinct_ratings)
+        self.assertEqual(aggregated, 5)
+
+        aggregated = self.generic_aggregate(
+            Food.objects.filter(name='apple'),
+            Rating.objects.filter(created__gte=datetime.date.today()),
+            distinct_ratings)
+        self.assertEqual(aggregated, 2)
+
+    def test_expression_aggregates(self):
+        squares = models.Sum(F('ratings__rating') * F('ratings__rating'))
+        annotated_qs = self.generic_annotate(Food, Rating, squares)
+        self.assertEqual(
+            {'apple': 44, 'orange': 89, 'peach': None},
+            {food.name: food.score for food in annotated_qs})
+
+        aggregated = self.generic_aggregate(Food, Rating, squares)
+        self.assertEqual(aggregated, 133)
+
+        aggregated = self.generic_aggregate(
+            Food.objects.filter(name='orange'),
+            Rating,
+            models.Max(F('ratings__rating') - F('ratings__object_id')))
+        self.assertEqual(aggregated, 8 - self.orange.pk)
+
     def test_charfield_pks(self):
         a1 = CharFieldGFK.objects.create(name='a1', content_object=self.apple)
         a2 = CharFieldGFK.objects.create(name='a2', content_object=self.apple)
@@ -213,3 +319,616 @@ class FallbackTestCase(SimpleTest):
 
     def generic_filter(self, *args, **kwargs):
         return fallback_generic_filter(*args, **kwargs)
+
+
+class UtilsTestCase(RatingTestCase):
+    def test_annotate_top(self):
+        with self.assertNumQueries(2):
+            foods = generic_annotate_top(Food.objects.order_by('name'), Rating, 2, ['-rating'])
+            top = dict((food.name, [r.rating for r in food.top]) for food in foods)
+        self.assertEqual(top, {'apple': [5, 3], 'orange': [8, 4], 'peach': []})
+        self.assertEqual([food.name for food in foods], ['apple', 'orange', 'peach'])
+
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        foods = generic_annotate_top(
+            Food.objects.filter(name='apple'),
+            todays_ratings,
+            3,
+            ['rating'],
+            alias='lowest')
+        self.assertEqual(len(foods), 1)
+        self.assertEqual([r.rating for r in foods[0].lowest], [3, 5])
+        self.assertTrue(all(r.content_object == self.apple for r in foods[0].lowest))
+
+        self.assertEqual(generic_annotate_top(Food.objects.none(), Rating, 2, ['-rating']), [])
+
+    def test_annotate_top_charfield_pks(self):
+        CharFieldGFK.objects.create(name='a1', content_object=self.apple)
+        CharFieldGFK.objects.create(name='a2', content_object=self.apple)
+        CharFieldGFK.objects.create(name='o1', content_object=self.orange)
+
+        foods = generic_annotate_top(Food.objects.order_by('name'), CharFieldGFK, 1, ['-name'])
+        self.assertEqual([[c.name for c in food.top] for food in foods], [['a2'], ['o1'], []])
+
+    def test_annotate_keyset(self):
+        for i in range(5):
+            food = Food.objects.create(name='food-%d' % i)
+            for rating in range(i % 3):
+                Rating.objects.create(content_object=food, rating=rating + 2)
+
+        def pages(aggregator, page_size, **kwargs):
+            after = None
+            while True:
+                page = generic_annotate_keyset(
+                    Food, Rating, aggregator, after, page_size, **kwargs)
+                if not page:
+                    break
+                yield [(food.name, food.score) for food in page]
+                after = (page[-1].score, page[-1].pk)
+
+        def expected(aggregator, descending=True):
+            foods = list(_generic_annotate(Food, Rating, aggregator))
+            # objects without a value come last
+            valued = [food for food in foods if food.score is not None]
+            valued.sort(key=lambda food: (food.score, food.pk), reverse=descending)
+            unvalued = [food for food in foods if food.score is None]
+            unvalued.sort(key=lambda food: food.pk, reverse=descending)
+            foods = valued + unvalued
+            return [(food.name, food.score) for food in foods]
+
+        for aggregator in (models.Count('ratings__rating'), models.Sum('ratings__rating')):
+            for descending in (True, False):
+                all_rows = expected(aggregator, descending)
+                self.assertEqual(len(all_rows), 8)
+                for page_size in (1, 3, 8):
+                    result = list(pages(aggregator, page_size, descending=descending))
+                    self.assertEqual(len(result), -(-8 // page_size))
+                    self.assertEqual(sum(result, []), all_rows)
+
+        page = generic_annotate_keyset(
+            Food.objects.filter(name__in=['apple', 'orange']),
+            Rating.objects.filter(created__gte=datetime.date.today()),
+            models.Sum('ratings__rating'),
+            alias='total')
+        self.assertEqual([(food.name, food.total) for food in page],
+                         [('apple', 8), ('orange', 7)])
+
+    def test_annotate_values(self):
+        rows = generic_annotate_values(
+            Food.objects.all(),
+            Rating,
+            models.Count('ratings__rating'),
+            ['name'],
+            alias='count').order_by('-count')
+        self.assertEqual(list(rows), [
+            {'name': 'apple', 'count': 4},
+            {'name': 'orange', 'count': 3},
+            {'name': 'peach', 'count': 0},
+        ])
+
+        rows = generic_annotate_values(
+            Food.objects.filter(name='orange'),
+            Rating,
+            models.Sum('ratings__rating'),
+            tuples=True)
+        self.assertEqual(list(rows), [(self.orange.pk, 'orange', None, 0, 15)])
+
+    def test_annotate_iterator(self):
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        scores = generic_annotate_iterator(
+            Food,
+            todays_ratings,
+            models.Sum('ratings__rating'),
+            chunk_size=2)
+        self.assertEqual(list(scores), [
+            (self.apple.pk, 8),
+            (self.orange.pk, 7),
+            (self.peach.pk, None),
+        ])
+
+        with self.assertNumQueries(1):
+            scores = dict(generic_annotate_iterator(
+                Food.objects.exclude(name='peach'),
+                Rating,
+                models.Count('ratings__rating')))
+        self.assertEqual(scores, {self.apple.pk: 4, self.orange.pk: 3})
+
+    def test_reduce(self):
+        medians = generic_reduce(Food, Rating, Median, ['rating'], chunk_size=2)
+        self.assertEqual(list(medians), [(self.apple.pk, 3.0), (self.orange.pk, 4)])
+
+        # only the generic objects of the queryset's objects are reduced
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        medians = generic_reduce(Food.objects.filter(name='orange'), todays_ratings, Median, ['rating'])
+        self.assertEqual(list(medians), [(self.orange.pk, 3.5)])
+
+        self.assertRaises(ValueError, generic_reduce, Food, CharFieldGFK, Median, ['name'], processes=2)
+        # the pool processes would not see the changes of the transaction
+        self.assertRaises(ValueError, generic_reduce, Food, Rating, Median, ['rating'], processes=2)
+
+    def test_lazy_aggregate(self):
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        with AggregateCollector():
+            with self.assertNumQueries(0):
+                avg = lazy_generic_aggregate(Food, Rating, models.Avg('ratings__rating'))
+                count = lazy_generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+                same_count = lazy_generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+                todays_sum = lazy_generic_aggregate(
+                    Food.objects.filter(name='apple'),
+                    todays_ratings,
+                    models.Sum('ratings__rating'))
+
+            with self.assertNumQueries(1) as context:
+                self.assertEqual(str(count), '7')
+            self.assertEqual(context.captured_queries[0]['sql'].count('SELECT COUNT'), 1)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(avg.value, 27 / 7.0)
+                self.assertEqual(same_count, 7)
+                self.assertEqual(todays_sum, 8)
+
+            # created after the others were computed
+            unused = lazy_generic_aggregate(Food, Rating, models.Max('ratings__rating'))
+            peach_max = lazy_generic_aggregate(
+                Food.objects.filter(name='peach'), Rating, models.Max('ratings__rating'))
+            with self.assertNumQueries(1):
+                self.assertFalse(peach_max)
+                self.assertEqual(int(unused), 8)
+
+        # without a collector each aggregate is computed on its own
+        count = lazy_generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+        total = lazy_generic_aggregate(Food, Rating, models.Sum('ratings__rating'))
+        with self.assertNumQueries(2):
+            self.assertEqual(count, 7)
+            self.assertEqual(total, 27)
+
+    def test_lazy_aggregate_failure(self):
+        with AggregateCollector() as collector:
+            count = lazy_generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+            broken = lazy_generic_aggregate(Food, Rating, models.Sum('ratings__nonexistent'))
+            empty = lazy_generic_aggregate(
+                Food.objects.filter(pk__in=[]), Rating, models.Count('ratings__rating'))
+            self.assertRaises(FieldError, lambda: broken.value)
+
+            # nothing was computed, so all are still pending
+            self.assertFalse(count.evaluated)
+            self.assertEqual(len(collector.pending), 3)
+
+            # the failing aggregates are left out, and stay pending
+            with self.assertNumQueries(1):
+                self.assertEqual(count.value, 7)
+            self.assertTrue(count.evaluated)
+            self.assertEqual(len(collector.pending), 2)
+            self.assertTrue(collector.pending[0] is broken)
+            self.assertTrue(collector.pending[1] is empty)
+            self.assertRaises(FieldError, lambda: broken.value)
+            self.assertRaises(EmptyResultSet, lambda: empty.value)
+
+            # an aggregate is computed even if no longer pending
+            other = lazy_generic_aggregate(Food, Rating, models.Sum('ratings__rating'))
+            collector.pending = []
+            with self.assertNumQueries(1):
+                self.assertEqual(other.value, 27)
+            self.assertTrue(other.evaluated)
+
+    def test_collector_middleware(self):
+        request = RequestFactory().get('/')
+        middleware = AggregateCollectorMiddleware()
+        middleware.process_request(request)
+        self.assertTrue(get_collector() is request.generic_aggregates)
+
+        count = lazy_generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+        self.assertEqual(request.generic_aggregates.pending, [count])
+
+        response = HttpResponse()
+        self.assertTrue(middleware.process_response(request, response) is response)
+        self.assertTrue(get_collector() is None)
+        self.assertEqual(count, 7)
+
+    def test_update(self):
+        Food.objects.filter(pk=self.peach.pk).update(rating_count=10, avg_rating=1.0)
+
+        updated = generic_update(Food, Rating, models.Count('ratings__rating'), 'rating_count')
+        self.assertEqual(updated, 3)
+        updated = generic_update(Food, Rating, models.Avg('ratings__rating'), 'avg_rating')
+        self.assertEqual(updated, 3)
+        self.assertEqual(list(Food.objects.values_list('name', 'rating_count', 'avg_rating').order_by('name')), [
+            ('apple', 4, 3.0),
+            ('orange', 3, 5.0),
+            ('peach', 0, None),
+        ])
+
+        # only the objects of the queryset are touched, in batches
+        todays_ratings = Rating.objects.filter(created__gte=datetime.date.today())
+        updated = generic_update(
+            Food.objects.exclude(name='peach'),
+            todays_ratings,
+            models.Count('ratings__rating'),
+            'rating_count',
+            batch_size=1)
+        self.assertEqual(updated, 2)
+        self.assertEqual(list(Food.objects.values_list('name', 'rating_count').order_by('name')), [
+            ('apple', 2),
+            ('orange', 2),
+            ('peach', 0),
+        ])
+
+        self.assertEqual(generic_update(
+            Food.objects.none(),
+            Rating,
+            models.Count('ratings__rating'),
+            'rating_count',
+            batch_size=10), 0)
+
+
+class IndexAdvisorTestCase(TestCase):
+    def test_check(self):
+        app_config = apps.get_app_config('generic_aggregation_tests')
+        warnings = check_gfk_indexes([app_config])
+        self.assertEqual([w.obj for w in warnings], [CharFieldGFK])
+        self.assertEqual(warnings[0].id, 'generic_aggregation.W001')
+        self.assertTrue('Meta.index_together and run makemigrations' in warnings[0].hint)
+
+    def test_inspect(self):
+        apple = Food.objects.create(name='apple')
+        Rating.objects.create(content_object=apple, rating=5)
+
+        report = inspect_gfk_indexes(Rating, Rating.content_object, 'rating')
+        self.assertEqual(report.fields, ['content_type', 'object_id', 'rating'])
+        self.assertEqual(len(report.usable), 1)
+        self.assertTrue(report.usable[0] in ' '.join(report.plan))
+
+        # the index Django creates for the content_type foreign key is not
+        # reported, as it cannot be dropped
+        self.assertEqual(report.unused, [])
+
+        # the plans are those of the queries generated for Food
+        if connection.vendor == 'sqlite':
+            self.assertTrue(any('generic_aggregation_tests_food' in line for line in report.plan))
+
+        report = inspect_gfk_indexes(CharFieldGFK, CharFieldGFK.content_object)
+        self.assertEqual(report.usable, [])
+
+    def test_inspect_content_types(self):
+        # inspecting does not create content types, neither for the generic
+        # model nor for models with a GenericRelation to it
+        self.addCleanup(ContentType.objects.clear_cache)
+        self.addCleanup(clear_content_type_ids)
+        ContentType.objects.filter(model__in=['rating', 'food', 'uuidfood']).delete()
+        ContentType.objects.clear_cache()
+        clear_content_type_ids()
+
+        report = inspect_gfk_indexes(Rating, Rating.content_object)
+        self.assertEqual(len(report.usable), 1)
+        self.assertFalse(ContentType.objects.filter(model__in=['rating', 'food']).exists())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('gfk_indexes', 'generic_aggregation_tests', stdout=out)
+        output = out.getvalue()
+
+        self.assertTrue('generic_aggregation_tests.Rating.content_object: ok' in output)
+        self.assertTrue(
+            'generic_aggregation_tests.CharFieldGFK.content_object: missing index '
+            'on (content_type_id, object_id)' in output)
+        self.assertTrue(
+            "CharFieldGFK.Meta: index_together = [('content_type', 'object_id')]" in output)
+        self.assertTrue("('generic_aggregation_tests', '0005_archivedrating')" in output)
+        self.assertTrue("name='charfieldgfk'" in output)
+        self.assertTrue("index_together=set([('content_type', 'object_id')])" in output)
+
+
+class ContentTypeTestCase(TestCase):
+    def setUp(self):
+        clear_content_type_ids()
+        ContentType.objects.clear_cache()
+
+    def test_warm_content_types(self):
+        with self.assertNumQueries(1):
+            warm_content_types()
+
+        # the pinned ids outlive the contenttypes cache
+        ContentType.objects.clear_cache()
+        Food.objects.create(name='apple')
+
+        with self.assertNumQueries(1):
+            aggregated = _generic_aggregate(Food, Rating, models.Count('ratings__rating'))
+        self.assertEqual(aggregated, 0)
+
+        with self.assertNumQueries(1):
+            annotated = list(_generic_annotate(Food, Rating, models.Count('ratings__rating')))
+        self.assertEqual([food.score for food in annotated], [0])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(_generic_filter(Rating, Food)), [])
+
+    def test_content_type_parameter(self):
+        content_type = ContentType.objects.get_for_model(Food)
+        sql, params = generic_aggregate_sql(Food, Rating, models.Count('ratings__rating'))
+        self.assertTrue(content_type.pk in params)
+
+        annotated_qs = _generic_annotate(Food, Rating, models.Count('ratings__rating'))
+        self.assertEqual(list(annotated_qs.query.extra_select['score'][1]), [content_type.pk])
+
+
+class UUIDTestCase(TestCase):
+    def setUp(self):
+        self.apple = UUIDFood.objects.create(name='apple')
+        self.orange = UUIDFood.objects.create(name='orange')
+        self.peach = UUIDFood.objects.create(name='peach')
+
+        for food, ratings in ((self.apple, [5, 3]), (self.orange, [4, 3, 8])):
+            for rating in ratings:
+                UUIDRating.objects.create(content_object=food, rating=rating)
+                CharFieldGFK.objects.create(content_object=food, name='%s-%s' % (food.name, rating))
+
+        # ratings of a Food sharing its primary key must not be counted
+        food = Food.objects.create(name='apple')
+        Rating.objects.create(content_object=food, rating=1)
+        CharFieldGFK.objects.create(content_object=food, name='food-apple')
+
+    def test_annotate(self):
+        qs = _generic_annotate(UUIDFood, UUIDRating, models.Count('ratings__rating'), alias='count')
+        self.assertEqual(sorted((food.name, food.count) for food in qs), [
+            ('apple', 2), ('orange', 3), ('peach', 0)])
+
+        qs = _generic_annotate(UUIDFood, CharFieldGFK, models.Count('char_gfk__name'), alias='count')
+        self.assertEqual(sorted((food.name, food.count) for food in qs), [
+            ('apple', 2), ('orange', 3), ('peach', 0)])
+
+        qs = _generic_annotate(Food, CharFieldGFK, models.Count('char_gfk__name'), alias='count')
+        self.assertEqual([(food.name, food.count) for food in qs], [('apple', 1)])
+
+    def test_aggregate(self):
+        apples = UUIDFood.objects.filter(name='apple')
+        self.assertEqual(_generic_aggregate(UUIDFood, UUIDRating, models.Sum('ratings__rating')), 23)
+        self.assertEqual(_generic_aggregate(apples, UUIDRating, models.Sum('ratings__rating')), 8)
+        self.assertEqual(_generic_aggregate(UUIDFood, CharFieldGFK, models.Count('char_gfk__name')), 5)
+        self.assertEqual(_generic_aggregate(apples, CharFieldGFK, models.Count('char_gfk__name')), 2)
+
+    def test_filter(self):
+        qs = _generic_filter(CharFieldGFK.objects.all(), UUIDFood.objects.filter(name='apple'))
+        self.assertEqual(sorted(obj.name for obj in qs), ['apple-3', 'apple-5'])
+        for obj in qs:
+            self.assertEqual(obj.content_object, self.apple)
+
+        qs = _generic_filter(UUIDRating.objects.all(), UUIDFood.objects.filter(name='orange'))
+        self.assertEqual(sorted(obj.rating for obj in qs), [3, 4, 8])
+
+    def test_top_and_reduce(self):
+        foods = generic_annotate_top(UUIDFood.objects.order_by('name'), CharFieldGFK, 1, ['-name'])
+        self.assertEqual([[obj.name for obj in food.top] for food in foods], [
+            ['apple-5'], ['orange-8'], []])
+
+        medians = dict(generic_reduce(UUIDFood, UUIDRating, Median, ['rating']))
+        self.assertEqual(medians, {self.apple.pk: 4.0, self.orange.pk: 4})
+
+    def test_annotate_keyset(self):
+        count = models.Count('ratings__rating')
+        page = generic_annotate_keyset(UUIDFood, UUIDRating, count, page_size=2)
+        self.assertEqual([(food.name, food.score) for food in page], [('orange', 3), ('apple', 2)])
+
+        last = page[-1]
+        page = generic_annotate_keyset(UUIDFood, UUIDRating, count, after=(last.score, last.pk))
+        self.assertEqual([(food.name, food.score) for food in page], [('peach', 0)])
+
+    def test_no_gfk_cast(self):
+        # the primary key is converted rather than every object id
+        gfk_cast = 'CAST(%s' % connection.ops.quote_name('object_id')
+        for model, aggregator in ((UUIDRating, models.Count('ratings__rating')),
+                                  (CharFieldGFK, models.Count('char_gfk__name'))):
+            sql, params = generic_annotate_sql(UUIDFood, model, aggregator)
+            self.assertFalse(gfk_cast in sql)
+            sql, params = generic_aggregate_sql(UUIDFood, model, aggregator)
+            self.assertFalse(gfk_cast in sql)
+
+        sql, params = generic_aggregate_sql(Food, CharFieldGFK, models.Count('char_gfk__name'))
+        self.assertFalse(gfk_cast in sql)
+
+    @sqlite_plans
+    def test_indexed_plan(self):
+        # without a cast the index on the object id is used
+        sql, params = generic_aggregate_sql(UUIDFood, UUIDRating, models.Sum('ratings__rating'))
+        plan = ' '.join(explain(sql, params))
+        self.assertTrue('generic_aggregation_tests_uuidrating_content_type_id_' in plan, plan)
+
+
+class QueryPlanTestCase(GenericAggregationTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rand = random.Random(0)
+        Food.objects.bulk_create(Food(name='food-%03d' % i) for i in range(200))
+        foods = list(Food.objects.all())
+        content_type = ContentType.objects.get_for_model(Food)
+
+        Rating.objects.bulk_create(
+            Rating(content_type=content_type, object_id=food.pk, rating=rand.randint(1, 10))
+            for food in foods
+            for i in range(rand.randint(0, 10)))
+        CharFieldGFK.objects.bulk_create(
+            CharFieldGFK(content_type=content_type, object_id=str(food.pk), name=food.name)
+            for food in foods[::4])
+
+    def setUp(self):
+        self.rating_table = Rating._meta.db_table
+        self.count = models.Count('ratings__rating')
+        self.high_ratings = Rating.objects.filter(rating__gte=5)
+
+    def assertIndexedPlan(self, plan):
+        self.assertNoFullScan(plan, self.rating_table)
+        self.assertNoTempBTree(plan)
+
+    @sqlite_plans
+    def test_annotate_plan(self):
+        for annotate in (_generic_annotate, fallback_generic_annotate):
+            for generic_qs in (Rating, self.high_ratings):
+                qs = annotate(Food, generic_qs, self.count)
+                self.assertIndexedPlan(queryset_plan(qs))
+
+    @sqlite_plans
+    def test_annotate_values_plan(self):
+        qs = generic_annotate_values(Food, self.high_ratings, self.count, ['name'])
+        self.assertIndexedPlan(queryset_plan(qs))
+
+        # the query of each chunk of generic_annotate_iterator
+        qs = generic_annotate_values(
+            Food.objects.order_by('pk'),
+            Rating,
+            self.count,
+            ['pk'],
+            tuples=True)
+        self.assertIndexedPlan(queryset_plan(qs.filter(pk__gt=100)[:50]))
+
+    @sqlite_plans
+    def test_aggregate_plan(self):
+        some_foods = Food.objects.filter(pk__lte=10)
+        for qs in (Food, some_foods):
+            for generic_qs in (Rating, self.high_ratings):
+                sql, params = generic_aggregate_sql(qs, generic_qs, self.count)
+                self.assertIndexedPlan(explain(sql, params))
+
+    @sqlite_plans
+    def test_filter_plan(self):
+        foods = Food.objects.filter(pk__lte=10)
+        for generic_filter in (_generic_filter, fallback_generic_filter):
+            for generic_qs in (Rating, self.high_ratings):
+                qs = generic_filter(generic_qs, foods)
+                self.assertIndexedPlan(queryset_plan(qs))
+
+    @sqlite_plans
+    def test_annotate_top_plan(self):
+        foods = list(Food.objects.all()[:20])
+        for generic_qs in (Rating.objects.all(), self.high_ratings):
+            # an ordering following the index needs no sorting
+            sql, params = generic_top_sql(
+                foods, generic_qs, 3, ['rating'], get_gfk_field(Rating))
+            self.assertIndexedPlan(explain(sql, params))
+
+            sql, params = generic_top_sql(
+                foods, generic_qs, 3, ['-created'], get_gfk_field(Rating))
+            self.assertNoFullScan(explain(sql, params), self.rating_table)
+
+    def test_query_counts(self):
+        foods = self.assertNumQueriesEvaluated(
+            1, _generic_annotate, Food, self.high_ratings, self.count)
+        self.assertEqual(len(foods), 200)
+
+        self.assertNumQueriesEvaluated(1, _generic_aggregate, Food, Rating, self.count)
+        self.assertNumQueriesEvaluated(1, _generic_filter, Rating, Food.objects.filter(pk__lte=10))
+        self.assertNumQueriesEvaluated(
+            1, generic_annotate_values, Food, Rating, self.count, ['name'])
+        self.assertNumQueriesEvaluated(
+            4, generic_annotate_iterator, Food, Rating, self.count, chunk_size=60)
+
+        page = self.assertNumQueriesEvaluated(
+            2, generic_annotate_keyset, Food, Rating, self.count, page_size=20)
+        self.assertEqual(len(page), 20)
+        page = self.assertNumQueriesEvaluated(
+            2, generic_annotate_keyset, Food, Rating, self.count, (page[-1].score, page[-1].pk))
+        self.assertEqual(len(page), 20)
+
+        foods = self.assertNumQueriesEvaluated(
+            2, generic_annotate_top, Food.objects.all()[:20], Rating, 3, ['-rating'])
+        self.assertTrue(all(len(food.top) <= 3 for food in foods))
+
+
+@skipIf(connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['NAME']),
+        'pool processes cannot share an in-memory database')
+class ReduceProcessesTestCase(TransactionTestCase):
+    # the pool processes read with their own connections, so the data must be
+    # committed
+    def setUp(self):
+        self.foods = [Food.objects.create(name='food-%d' % i) for i in range(5)]
+        for food in self.foods:
+            for rating in range(food.pk % 4):
+                Rating.objects.create(content_object=food, rating=rating)
+
+    def test_reduce_processes(self):
+        expected = list(generic_reduce(Food, Rating, Median, ['rating']))
+        self.assertEqual(len(expected), 4)
+
+        for processes in (1, 2, 3, 10):
+            medians = generic_reduce(Food, Rating, Median, ['rating'], chunk_size=2, processes=processes)
+            self.assertEqual(list(medians), expected)
+
+        # the connection of this process is still usable
+        self.assertEqual(Food.objects.count(), 5)
+
+
+class ShardTestCase(TransactionTestCase):
+    # the shards are read from other threads, so the data must be committed
+    multi_db = True
+
+    def setUp(self):
+        self.apple = Food.objects.create(name='apple')
+        self.orange = Food.objects.create(name='orange')
+
+        self.shards = {
+            'default': [(self.apple, 5), (self.apple, 3), (self.orange, 4)],
+            'shard_a': [(self.apple, 1), (self.orange, 8)],
+            'shard_b': [(self.orange, 3)],
+        }
+        for using, ratings in self.shards.items():
+            content_type = ContentType.objects.db_manager(using).get_for_model(Food)
+            for food, rating in ratings:
+                Rating.objects.using(using).create(
+                    content_type=content_type,
+                    object_id=food.pk,
+                    rating=rating)
+
+        self.querysets = [Rating.objects.using(using) for using in sorted(self.shards)]
+
+    def test_aggregate_shards(self):
+        aggregate = lambda qs_model, aggregator: generic_aggregate_shards(
+            qs_model, self.querysets, aggregator)
+
+        self.assertEqual(aggregate(Food, models.Count('ratings__rating')), 6)
+        self.assertEqual(aggregate(Food, models.Sum('ratings__rating')), 24)
+        self.assertEqual(aggregate(Food, models.Min('ratings__rating')), 1)
+        self.assertEqual(aggregate(Food, models.Max('ratings__rating')), 8)
+        self.assertEqual(aggregate(Food, models.Avg('ratings__rating')), 4.0)
+
+        apples = Food.objects.filter(name='apple')
+        self.assertEqual(aggregate(apples, models.Avg('ratings__rating')), 3.0)
+        self.assertEqual(aggregate(apples, models.Max('ratings__rating')), 5)
+
+        nothing = Food.objects.filter(name='peach')
+        self.assertEqual(aggregate(nothing, models.Count('ratings__rating')), 0)
+        self.assertEqual(aggregate(nothing, models.Avg('ratings__rating')), None)
+
+    def test_aggregate_shards_filtered(self):
+        querysets = [qs.filter(rating__gte=4) for qs in self.querysets]
+        aggregated = generic_aggregate_shards(
+            Food, querysets, models.Avg('ratings__rating'), threads=2)
+        self.assertEqual(aggregated, 17 / 3.0)
+
+    def test_aggregate_shard_models(self):
+        ArchivedRating.objects.create(content_object=self.apple, rating=2)
+        ArchivedRating.objects.create(content_object=self.orange, rating=6)
+        querysets = self.querysets + [ArchivedRating]
+
+        for gfk_field in (None, Rating.content_object):
+            aggregate = lambda qs_model, aggregator: generic_aggregate_shards(
+                qs_model, querysets, aggregator, gfk_field)
+            self.assertEqual(aggregate(Food, models.Count('ratings__rating')), 8)
+            self.assertEqual(aggregate(Food, models.Sum('ratings__rating')), 32)
+            self.assertEqual(aggregate(Food, models.Avg('ratings__rating')), 4.0)
+            self.assertEqual(aggregate(Food.objects.filter(name='apple'), models.Min('ratings__rating')), 1)
+
+    def test_shard_partials(self):
+        # the partials of an average are selected by a single query per shard
+        sql, params = generic_aggregate_sql(
+            Food, Rating.objects.using('shard_a'),
+            [models.Sum('ratings__rating'), models.Count('ratings__rating')])
+        cursor = connections['shard_a'].cursor()
+        cursor.execute(sql, params)
+        self.assertEqual(cursor.fetchone(), (9, 2))
+
+    def test_aggregate_shards_empty(self):
+        self.assertEqual(generic_aggregate_shards(Food, [], models.Count('ratings__rating')), 0)
+        self.assertEqual(generic_aggregate_shards(Food, [], models.Avg('ratings__rating')), None)
+
+    def test_aggregate_shards_distinct(self):
+        self.assertRaises(ValueError, generic_aggregate_shards,
+                          Food, self.querysets,
+                          models.Count('ratings__rating', distinct=True))
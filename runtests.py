@@ -25,10 +25,20 @@ if not settings.configured:
             'default': {
                 'ENGINE': db_engine,
                 'NAME': db_name,
-            }
+            },
+            # extra databases for testing generic data split across shards
+            'shard_a': {
+                'ENGINE': db_engine,
+                'NAME': db_name and db_name + '_shard_a',
+            },
+            'shard_b': {
+                'ENGINE': db_engine,
+                'NAME': db_name and db_name + '_shard_b',
+            },
         },
         INSTALLED_APPS=[
             'django.contrib.contenttypes',
+            'generic_aggregation',
             'generic_aggregation_tests',
         ],
         MIDDLEWARE_CLASSES=(
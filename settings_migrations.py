@@ -9,6 +9,7 @@ DATABASES = {
 
 INSTALLED_APPS = [
     'django.contrib.contenttypes',
+    'generic_aggregation',
     'generic_aggregation_tests',
 ]
 